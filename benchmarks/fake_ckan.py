@@ -0,0 +1,267 @@
+"""A local stand-in for the CKAN action API, for benchmarking without a live CKAN.
+
+Only the actions used by ckan_editor_utils are implemented, backed by in-memory dicts. Uploaded parts are
+counted but not kept, so the fake's memory use stays flat however much data is pushed through it.
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, unquote, urlparse
+
+import gzip
+import json
+import random
+import socket
+import threading
+import time
+import uuid
+
+
+def _parse_multipart(body: bytes, content_type: str) -> dict:
+    boundary = content_type.split('boundary=', 1)[1].strip('"').encode()
+    fields = dict()
+    for section in body.split(b'--' + boundary)[1:-1]:
+        head, _, value = section[2:].partition(b'\r\n\r\n')
+        name = head.split(b'name="', 1)[1].split(b'"', 1)[0].decode()
+        value = value[:-2]
+        fields[name] = value if b'filename=' in head else value.decode()
+    return fields
+
+
+class FakeCKAN(object):
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        # latency is added to every call; error_rate is the share of calls answered with a 503
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+        self.datasets = dict()
+        self.uploads = dict()
+        self.lock = threading.Lock()
+
+    def handle(self, action: str, data: dict):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            if self.random.random() < self.error_rate:
+                return 503, 'Service unavailable'
+
+            handler = getattr(self, 'action_' + action, None)
+            if handler is None:
+                return 400, dict(success=False, error=dict(message='Unknown action ' + action))
+            return handler(data)
+
+    @staticmethod
+    def _ok(result):
+        return 200, dict(success=True, result=result)
+
+    @staticmethod
+    def _not_found():
+        return 404, dict(success=False, error=dict(message='Not found', __type='Not Found Error'))
+
+    def _find_dataset(self, dataset_id):
+        dataset = self.datasets.get(dataset_id)
+        if dataset is None:
+            dataset = next((d for d in self.datasets.values() if d['id'] == dataset_id), None)
+        return dataset
+
+    def _find_resource(self, resource_id):
+        for dataset in self.datasets.values():
+            for resource in dataset['resources']:
+                if resource['id'] == resource_id:
+                    return dataset, resource
+        return None, None
+
+    def action_site_read(self, data):
+        return self._ok(True)
+
+    def action_package_show(self, data):
+        dataset = self._find_dataset(data.get('id'))
+        return self._ok(dataset) if dataset else self._not_found()
+
+    def action_package_search(self, data):
+        rows = int(data.get('rows', 10))
+        start = int(data.get('start', 0))
+        datasets = sorted(self.datasets.values(), key=lambda d: d['name'])
+        return self._ok(dict(count=len(datasets), results=datasets[start:start + rows]))
+
+    def action_package_create(self, data):
+        if data['name'] in self.datasets:
+            return 409, dict(success=False, error=dict(name=['That URL is already in use.']))
+        dataset = dict(data, id=str(uuid.uuid4()), resources=[], num_resources=0,
+                       organization=dict(name=data.get('owner_org'), description='Organisation'))
+        self.datasets[dataset['name']] = dataset
+        return self._ok(dataset)
+
+    def action_package_update(self, data):
+        dataset = self._find_dataset(data.get('id') or data.get('name'))
+        if dataset is None:
+            return self._not_found()
+        resources = dataset['resources']
+        dataset.clear()
+        dataset.update(data, resources=resources, num_resources=len(resources),
+                       organization=dict(name=data.get('owner_org'), description='Organisation'))
+        return self._ok(dataset)
+
+    def action_package_patch(self, data):
+        dataset = self._find_dataset(data.get('id'))
+        if dataset is None:
+            return self._not_found()
+        dataset.update(data)
+        return self._ok(dataset)
+
+    def action_package_delete(self, data):
+        dataset = self._find_dataset(data.get('id'))
+        if dataset is None:
+            return self._not_found()
+        dataset['state'] = 'deleted'
+        return self._ok(None)
+
+    def action_dataset_purge(self, data):
+        dataset = self._find_dataset(data.get('id'))
+        if dataset is None:
+            return self._not_found()
+        del self.datasets[dataset['name']]
+        return self._ok(None)
+
+    def action_resource_show(self, data):
+        _, resource = self._find_resource(data.get('id'))
+        return self._ok(resource) if resource else self._not_found()
+
+    def action_resource_create(self, data):
+        dataset = self._find_dataset(data.get('package_id'))
+        if dataset is None:
+            return self._not_found()
+        resource = {k: v for k, v in data.items() if not isinstance(v, bytes)}
+        resource['id'] = str(uuid.uuid4())
+        dataset['resources'].append(resource)
+        dataset['num_resources'] = len(dataset['resources'])
+        return self._ok(resource)
+
+    def action_resource_update(self, data):
+        _, resource = self._find_resource(data.get('id'))
+        if resource is None:
+            return self._not_found()
+        resource.clear()
+        resource.update({k: v for k, v in data.items() if not isinstance(v, bytes)})
+        return self._ok(resource)
+
+    def action_resource_patch(self, data):
+        _, resource = self._find_resource(data.get('id'))
+        if resource is None:
+            return self._not_found()
+        resource.update({k: v for k, v in data.items() if not isinstance(v, bytes)})
+        return self._ok(resource)
+
+    def action_resource_delete(self, data):
+        dataset, resource = self._find_resource(data.get('id'))
+        if resource is None:
+            return self._not_found()
+        dataset['resources'].remove(resource)
+        dataset['num_resources'] = len(dataset['resources'])
+        return self._ok(None)
+
+    def action_cloudstorage_initiate_multipart(self, data):
+        upload_id = str(uuid.uuid4())
+        self.uploads[upload_id] = dict(resource_id=data['id'], parts=dict())
+        _, resource = self._find_resource(data['id'])
+        if resource is not None:
+            resource['upload_in_progress'] = True
+        return self._ok(dict(id=upload_id, name=data.get('name'), size=data.get('size')))
+
+    def action_cloudstorage_upload_multipart(self, data):
+        upload = self.uploads.get(data['uploadId'])
+        if upload is None:
+            return self._not_found()
+        upload['parts'][int(data['partNumber'])] = len(data['upload'])
+        return self._ok(dict(partNumber=int(data['partNumber'])))
+
+    def action_cloudstorage_finish_multipart(self, data):
+        upload = self.uploads.pop(data['uploadId'], None)
+        if upload is None:
+            return self._not_found()
+        _, resource = self._find_resource(upload['resource_id'])
+        if resource is not None:
+            resource.pop('upload_in_progress', None)
+        return self._ok(dict(commited=True, size=sum(upload['parts'].values())))
+
+    def action_cloudstorage_abort_multipart(self, data):
+        for upload_id, upload in list(self.uploads.items()):
+            if upload['resource_id'] == data['id']:
+                del self.uploads[upload_id]
+        return self._ok(True)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        # Headers and body are written separately, which stalls on delayed ACKs without this
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> bytes:
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = b''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def _parse_body(self, body: bytes) -> dict:
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            return _parse_multipart(body, content_type)
+        if content_type.startswith('application/json'):
+            return json.loads(body)
+
+        # ckan_editor_utils posts percent-encoded JSON; plain form posts are key=value pairs
+        text = body.decode()
+        try:
+            return json.loads(unquote(text))
+        except ValueError:
+            return {k: v[0] for k, v in parse_qs(text).items()}
+
+    def _reply(self, action, data):
+        status, result = self.server.ckan.handle(action, data)
+        if status is None:
+            # Closes the connection without replying, as if the response had been lost
+            self.close_connection = True
+            return
+        body = (result if isinstance(result, str) else json.dumps(result)).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain' if isinstance(result, str) else 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self._reply(url.path.rsplit('/', 1)[-1], {k: v[0] for k, v in parse_qs(url.query).items()})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        self._reply(url.path.rsplit('/', 1)[-1], self._parse_body(self._read_body()))
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # The same as http.server.ThreadingHTTPServer, which needs Python 3.7
+    daemon_threads = True
+
+
+def make_server(ckan: FakeCKAN, host='127.0.0.1', port=0) -> _ThreadingHTTPServer:
+    server = _ThreadingHTTPServer((host, port), _Handler)
+    server.ckan = ckan
+    return server
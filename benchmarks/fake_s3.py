@@ -0,0 +1,139 @@
+"""A local stand-in for the parts of the S3 REST API that boto3 uses here.
+
+Supports path-style HeadObject, ranged GetObject and ListObjectsV2. Object contents are generated on demand
+from a fixed pseudo-random block, so very large objects cost no memory and always read back the same bytes.
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.sax.saxutils import escape
+
+import hashlib
+import random
+import socket
+
+_BLOCK = bytes(random.Random(0).getrandbits(8) for _ in range(1024 * 1024))
+_LAST_MODIFIED = 'Wed, 01 Jan 2020 00:00:00 GMT'
+
+
+class FakeS3(object):
+    def __init__(self):
+        # (bucket, key) -> size in bytes
+        self.objects = dict()
+
+    def add_object(self, bucket, key, size):
+        self.objects[(bucket, key)] = size
+
+    @staticmethod
+    def etag(bucket, key, size):
+        return '"{}"'.format(hashlib.md5('{}/{}/{}'.format(bucket, key, size).encode()).hexdigest())
+
+    @staticmethod
+    def read(offset, length):
+        block_size = len(_BLOCK)
+        chunks = []
+        while length > 0:
+            start = offset % block_size
+            chunk = _BLOCK[start:start + length]
+            chunks.append(chunk)
+            offset += len(chunk)
+            length -= len(chunk)
+        return b''.join(chunks)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        # Headers and body are written separately, which stalls on delayed ACKs without this
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _object(self):
+        url = urlparse(self.path)
+        bucket, _, key = url.path[1:].partition('/')
+        return bucket, unquote(key), parse_qs(url.query)
+
+    def _send(self, status, headers, body=b''):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _not_found(self):
+        body = b'<?xml version="1.0"?><Error><Code>NoSuchKey</Code><Message>Not found</Message></Error>'
+        self._send(404, {'Content-Type': 'application/xml', 'Content-Length': str(len(body))}, body)
+
+    def _list(self, bucket, query):
+        s3 = self.server.s3
+        prefix = query.get('prefix', [''])[0]
+        max_keys = int(query.get('max-keys', ['1000'])[0])
+        after = query.get('continuation-token', query.get('start-after', ['']))[0]
+
+        keys = sorted(k for b, k in s3.objects if b == bucket and k.startswith(prefix) and k > after)
+        page, truncated = keys[:max_keys], len(keys) > max_keys
+
+        contents = ''.join(
+            '<Contents><Key>{}</Key><LastModified>2020-01-01T00:00:00.000Z</LastModified><ETag>{}</ETag>'
+            '<Size>{}</Size><StorageClass>STANDARD</StorageClass></Contents>'.format(
+                escape(key), escape(s3.etag(bucket, key, s3.objects[(bucket, key)])), s3.objects[(bucket, key)])
+            for key in page
+        )
+        token = '<NextContinuationToken>{}</NextContinuationToken>'.format(escape(page[-1])) if truncated else ''
+        body = ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                '<Name>{}</Name><Prefix>{}</Prefix><KeyCount>{}</KeyCount><MaxKeys>{}</MaxKeys>'
+                '<IsTruncated>{}</IsTruncated>{}{}</ListBucketResult>').format(
+            escape(bucket), escape(prefix), len(page), max_keys, str(truncated).lower(), contents, token).encode()
+        self._send(200, {'Content-Type': 'application/xml', 'Content-Length': str(len(body))}, body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        bucket, key, query = self._object()
+        if not key and query.get('list-type') == ['2']:
+            return self._list(bucket, query)
+
+        size = self.server.s3.objects.get((bucket, key))
+        if size is None:
+            return self._not_found()
+
+        headers = {
+            'ETag': self.server.s3.etag(bucket, key, size),
+            'Last-Modified': _LAST_MODIFIED,
+            'Content-Type': 'binary/octet-stream',
+            'Accept-Ranges': 'bytes',
+        }
+        if_match = self.headers.get('If-Match')
+        if if_match is not None and if_match != headers['ETag']:
+            return self._send(412, {'Content-Length': '0'})
+
+        ranged = self.headers.get('Range')
+        if ranged:
+            first, _, last = ranged.split('=', 1)[1].partition('-')
+            first, last = int(first), min(int(last or size - 1), size - 1)
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(first, last, size)
+            headers['Content-Length'] = str(last - first + 1)
+            body = b'' if self.command == 'HEAD' else self.server.s3.read(first, last - first + 1)
+            return self._send(206, headers, body)
+
+        headers['Content-Length'] = str(size)
+        body = b'' if self.command == 'HEAD' else self.server.s3.read(0, size)
+        self._send(200, headers, body)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # The same as http.server.ThreadingHTTPServer, which needs Python 3.7
+    daemon_threads = True
+
+
+def make_server(s3: FakeS3, host='127.0.0.1', port=0) -> _ThreadingHTTPServer:
+    server = _ThreadingHTTPServer((host, port), _Handler)
+    server.s3 = s3
+    return server
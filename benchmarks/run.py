@@ -0,0 +1,209 @@
+"""Offline benchmarks for ckan_editor_utils against local CKAN and S3 stand-ins.
+
+Run from the repository root, eg:
+    python -m benchmarks.run --scenario all --datasets 10000 --object-size-mb 1024 --workers 16
+
+The fakes run in their own processes so that their CPU and memory use is not counted against the client.
+Peak RSS is the high-water mark of this process so far, so run one scenario at a time to compare them in isolation.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from . import fake_ckan, fake_s3
+
+BUCKET = 'benchmark-bucket'
+OBJECT_KEY = 'survey/large-object.bin'
+ORGANIZATION = 'benchmark-org'
+
+
+def _serve_ckan(latency, error_rate, seed, port_queue):
+    server = fake_ckan.make_server(fake_ckan.FakeCKAN(latency=latency, error_rate=error_rate, seed=seed))
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def _serve_s3(objects, port_queue):
+    s3 = fake_s3.FakeS3()
+    for (bucket, key), size in objects.items():
+        s3.add_object(bucket, key, size)
+    server = fake_s3.make_server(s3)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def _start(target, *args):
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=target, args=args + (port_queue,), daemon=True)
+    process.start()
+    return process, port_queue.get(timeout=30)
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and kilobytes elsewhere
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def _dataset(i):
+    name = 'benchmark-{:07d}'.format(i)
+    return {
+        'name': name,
+        'extra:identifier': name.upper(),
+        'notes': 'Benchmark dataset {}'.format(i),
+        'owner_org': ORGANIZATION,
+    }
+
+
+def scenario_put_datasets(editor, args):
+    results = editor.put_datasets((_dataset(i) for i in range(args.datasets)), skip_existing=False,
+                                  max_workers=args.workers)
+    failed = sum(not res.ok for _, res in results)
+    return args.datasets, failed, 0
+
+
+def setup_put_resource_from_s3(editor, args):
+    editor.put_dataset(_dataset(0))
+
+
+def scenario_put_resource_from_s3(editor, args):
+    res = editor.put_resource_from_s3(
+        {
+            'name': _dataset(0)['name'],
+            'resource:name': 'large-object-{}'.format(time.time()),
+            'resource:description': 'Benchmark object'
+        },
+        's3://{}/{}'.format(BUCKET, OBJECT_KEY),
+        skip_existing=False
+    )
+    return 1, int(not res.ok), args.object_size_mb * 1024 * 1024
+
+
+def setup_put_resource_from_file(editor, args):
+    editor.put_dataset(_dataset(0))
+    if not os.path.exists(args.file_path) or os.path.getsize(args.file_path) != args.object_size_mb * 1024 * 1024:
+        with open(args.file_path, 'wb') as f:
+            for offset in range(0, args.object_size_mb * 1024 * 1024, 1024 * 1024):
+                f.write(fake_s3.FakeS3.read(offset, 1024 * 1024))
+
+
+def scenario_put_resource_from_file(editor, args):
+    res = editor.put_resource_from_file(
+        {
+            'name': _dataset(0)['name'],
+            'resource:name': 'large-file-{}'.format(time.time()),
+            'resource:description': 'Benchmark file'
+        },
+        args.file_path,
+        skip_existing=False
+    )
+    return 1, int(not res.ok), args.object_size_mb * 1024 * 1024
+
+
+def setup_delete_datasets(editor, args):
+    # Make sure there is something to delete, even when run on its own
+    list(editor.put_datasets((_dataset(i) for i in range(args.datasets)), max_workers=args.workers))
+
+
+def scenario_delete_datasets(editor, args):
+    results = editor.delete_datasets((_dataset(i)['name'] for i in range(args.datasets)), max_workers=args.workers)
+    failed = sum(not res.ok for _, res in results)
+    return args.datasets, failed, 0
+
+
+# name -> (untimed setup, timed scenario)
+SCENARIOS = {
+    'put_datasets': (None, scenario_put_datasets),
+    'put_resource_from_s3': (setup_put_resource_from_s3, scenario_put_resource_from_s3),
+    'put_resource_from_file': (setup_put_resource_from_file, scenario_put_resource_from_file),
+    'delete_datasets': (setup_delete_datasets, scenario_delete_datasets),
+}
+
+
+def run_scenario(name, ckan_url, s3_url, args):
+    import boto3
+    import ckan_editor_utils
+
+    setup, scenario = SCENARIOS[name]
+    histogram = ckan_editor_utils.HistogramSink()
+    # Built here with the fake's endpoint, as the pinned boto3 does not read it from AWS_ENDPOINT_URL_S3
+    s3_resource = boto3.session.Session(aws_access_key_id='benchmark', aws_secret_access_key='benchmark').resource(
+        's3', endpoint_url=s3_url, region_name='us-east-1')
+
+    with ckan_editor_utils.CKANEditorSession(ckan_url, 'benchmark-key', pool_size=args.workers,
+                                             upload_workers=args.workers, retries=args.retries,
+                                             s3_resource=s3_resource) as editor:
+        if setup is not None:
+            setup(editor, args)
+
+        ckan_editor_utils.add_metrics_sink(histogram)
+        try:
+            start = time.monotonic()
+            items, failed, transferred = scenario(editor, args)
+            seconds = time.monotonic() - start
+        finally:
+            ckan_editor_utils.remove_metrics_sink(histogram)
+
+    return dict(
+        scenario=name,
+        items=items,
+        failed=failed,
+        seconds=seconds,
+        items_per_second=items / seconds,
+        mb_per_second=transferred / 1024 / 1024 / seconds,
+        peak_rss_mb=_peak_rss_mb(),
+        actions=histogram.summary(),
+    )
+
+
+def print_report(report):
+    print('\n{scenario}: {items} items in {seconds:.2f}s, {items_per_second:.1f} items/s, '
+          '{mb_per_second:.1f} MB/s, {failed} failed, peak RSS {peak_rss_mb:.0f} MB'.format(**report))
+    print('  {:<34} {:>8} {:>7} {:>8} {:>10} {:>10}'.format('action', 'calls', 'errors', 'retries', 'p50 ms', 'p99 ms'))
+    for action, stats in sorted(report['actions'].items()):
+        print('  {:<34} {:>8} {:>7} {:>8} {:>10.1f} {:>10.1f}'.format(
+            action, stats['count'], stats['errors'], stats['retries'], stats['p50'] * 1000, stats['p99'] * 1000))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS) + ['all'], default='all')
+    parser.add_argument('--datasets', type=int, default=10000, help='datasets for the put and delete scenarios')
+    parser.add_argument('--object-size-mb', type=int, default=1024, help='size of the S3 object or file to upload')
+    parser.add_argument('--file-path', default=os.path.join(tempfile.gettempdir(), 'ckan-editor-utils-benchmark.bin'),
+                        help='local file for put_resource_from_file, written on first use')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every fake CKAN call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of fake CKAN calls answered with 503')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print reports as JSON lines')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.ERROR)
+
+    ckan_process, ckan_port = _start(_serve_ckan, args.latency, args.error_rate, args.seed)
+    s3_process, s3_port = _start(_serve_s3, {(BUCKET, OBJECT_KEY): args.object_size_mb * 1024 * 1024})
+
+    try:
+        names = sorted(SCENARIOS) if args.scenario == 'all' else [args.scenario]
+        for name in names:
+            report = run_scenario(name, 'http://127.0.0.1:{}'.format(ckan_port), 'http://127.0.0.1:{}'.format(s3_port),
+                                  args)
+            if args.json:
+                print(json.dumps(report))
+            else:
+                print_report(report)
+    finally:
+        ckan_process.terminate()
+        s3_process.terminate()
+
+
+if __name__ == '__main__':
+    main()
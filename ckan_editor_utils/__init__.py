@@ -1,2 +1,3 @@
 __version__ = '0.1.8'
-from .ckan_editor_utils import *
\ No newline at end of file
+from .ckan_editor_utils import *
+from .pipeline import Pipeline, PipelineResult, read_csv, read_jsonl, parse_record, read_records, split_record
@@ -0,0 +1,325 @@
+from urllib.parse import urlparse
+
+import asyncio
+import json
+import os
+import logging
+import threading
+
+import aiohttp
+
+from .ckan_editor_utils import (DATASET_REQUIRED_ATTRS, RESOURCE_REQUIRED_ATTRS, AttributeUpdater, BodyEncoder,
+                                CKANResponse, UserException, _api_action_url, _check_upload_size, _default_encoder,
+                                _error_response, _part_size, _s3_resource, check_required_attrs)
+
+logger = logging.getLogger(__name__)
+
+
+class _AsyncResponse(object):
+    # Holds a fully read aiohttp response in the shape CKANResponse expects from requests
+
+    def __init__(self, status_code: int, text: str):
+        self.status_code = status_code
+        self.text = text
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncCKANEditor(object):
+    def __init__(self, url, key, session: aiohttp.ClientSession = None, pool_size=100, max_concurrency=50,
+                 upload_workers=1, max_inflight_bytes=None, s3_resource=None, encoder: BodyEncoder = None,
+                 chunk_size=1024 * 1024 * 5, max_part_size=1024 * 1024 * 1024 * 5, max_parts=10000):
+        self.url = url
+        self.key = key
+        self.pool_size = pool_size
+        # Caps the CKAN calls awaiting a response at once, across every task sharing this editor
+        self.max_concurrency = max_concurrency
+        self.upload_workers = upload_workers
+        self.max_inflight_bytes = max_inflight_bytes
+        # The same multipart part-size policy as CKANEditor
+        self.chunk_size = chunk_size
+        self.max_part_size = max_part_size
+        self.max_parts = max_parts
+        self.encoder = encoder if encoder is not None else _default_encoder
+
+        self._owns_session = session is None
+        self.session = session
+        self._semaphore = None
+
+        # Built on the first S3 operation, so CKAN-only use never imports boto3
+        self._s3 = s3_resource
+        self._s3_lock = threading.Lock()
+
+    @property
+    def s3(self):
+        if self._s3 is None:
+            with self._s3_lock:
+                if self._s3 is None:
+                    self._s3 = _s3_resource()
+        return self._s3
+
+    def part_size(self, size: int) -> int:
+        return _part_size(size, self.chunk_size, self.max_part_size, self.max_parts)
+
+    def _ensure_session(self):
+        # aiohttp sessions and semaphores must be created inside the running event loop
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                headers=dict(Authorization=self.key)
+            )
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def close(self):
+        if self._owns_session and self.session is not None:
+            await self.session.close()
+
+    async def action(self, name, data: dict = None, params: dict = None, form=None) -> CKANResponse:
+        # JSON payloads are encoded the same way as by the synchronous action functions
+        self._ensure_session()
+        kwargs = dict(headers=dict(Authorization=self.key))
+        if params is not None:
+            method = 'GET'
+            kwargs['params'] = params
+        else:
+            method = 'POST'
+            if form is not None:
+                kwargs['data'] = form
+            else:
+                kwargs['data'], headers = self.encoder.encode(data or dict())
+                kwargs['headers'].update(headers)
+
+        async with self._semaphore:
+            async with self.session.request(method, self.url + name, **kwargs) as response:
+                text = await response.text()
+                return CKANResponse(_AsyncResponse(response.status, text))
+
+    async def package_show(self, dataset_id) -> CKANResponse:
+        logger.info('Showing dataset ' + dataset_id)
+        return await self.action('package_show', params={'id': dataset_id})
+
+    async def put_dataset(self, data, skip_existing=True) -> CKANResponse:
+        res_show = await self.package_show(data['name'])
+
+        if not res_show.ok:
+
+            check_required_attrs(data, DATASET_REQUIRED_ATTRS, 'Dataset')
+
+            logger.info('Creating dataset ' + data['name'])
+            return await self.action('package_create', data)
+
+        elif skip_existing:
+            logger.info('Dataset {} exists, skipping'.format(data['name']))
+            return res_show
+
+        logger.info('Updating newly provided attributes for dataset {}'.format(data['name']))
+
+        au = AttributeUpdater()
+        new_ckan_content = au.update(res_show.result, data)
+
+        if au.edit_count > 0:
+            # hotfix to remove organisation markdown formatting that triggers firewall
+            new_ckan_content['organization'] = new_ckan_content['organization']['name']
+
+            logger.info('Updating dataset ' + data['name'])
+            return await self.action('package_update', new_ckan_content)
+        else:
+            logger.info('No change; update not requested')
+            return res_show
+
+    async def delete_dataset(self, dataset_id, delete_resources=True) -> CKANResponse:
+        # Returns the dataset_purge response, or the package_show response if the dataset could not be found
+        if not delete_resources:
+            logger.info('Purging dataset ' + dataset_id + ' with its resources')
+            return await self.action('dataset_purge', dict(id=dataset_id))
+
+        logger.info('Deleting and purging dataset ' + dataset_id + ' and its resources')
+        res_show = await self.package_show(dataset_id)
+        if not res_show.ok:
+            return res_show
+
+        # Each resource_delete rewrites the whole dataset in CKAN, so concurrent deletes could undo each other
+        for resource in res_show.result.get('resources', []):
+            await self.action('resource_delete', dict(id=resource['id']))
+
+        await self.action('package_delete', dict(id=dataset_id))
+        return await self.action('dataset_purge', dict(id=dataset_id))
+
+    async def put_resource_from_s3(self, data: dict, s3_path: str, skip_existing=True) -> CKANResponse:
+        res_show = await self.package_show(data['name'])
+
+        existing_resource_id = ''
+        current_resource_data = dict()
+        for cr in res_show.result.get('resources', []):
+            if cr['name'] == data['resource:name']:
+                if not existing_resource_id:
+                    current_resource_data = cr
+                    existing_resource_id = cr['id']
+                else:
+                    logger.warning('Multiple resources have been matched, skipping this update...')
+                    return res_show
+
+        if existing_resource_id:
+            if skip_existing:
+                logger.info(
+                    'Matched existing resource {} ({}), skipping...'.format(data['resource:name'], existing_resource_id)
+                )
+                return res_show
+            else:
+                logger.info(
+                    'Matched existing resource {} ({}), updating...'.format(data['resource:name'], existing_resource_id)
+                )
+
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        s3_path_parsed = urlparse(s3_path)
+        loop = asyncio.get_event_loop()
+
+        def load_object_summary():
+            # boto3 is blocking, so the S3 lookups run on the default executor
+            s3_object_summary = self.s3.ObjectSummary(
+                bucket_name=s3_path_parsed.netloc,
+                key=s3_path_parsed.path[1:]
+            )
+            s3_object_summary.load()
+            return s3_object_summary
+
+        try:
+            s3_object_summary = await loop.run_in_executor(None, load_object_summary)
+        except (BotoCoreError, ClientError) as e:
+            logger.error('Invalid S3 object: {}'.format(e))
+            return _error_response('Invalid S3 object: {}'.format(e))
+
+        _check_upload_size(s3_object_summary.size, self.max_part_size, self.max_parts)
+        obj_name = os.path.basename(s3_object_summary.key)
+        new_resource_data = {
+            'package_id': data['name'],
+            'url': obj_name,
+            'name': data['resource:name'],
+            'description': data['resource:description'],
+            'resource:description': data['resource:description'],
+            'multipart_name': obj_name,
+            'url_type': 'upload',
+            'size': s3_object_summary.size
+        }
+
+        if existing_resource_id:
+            updated_resource_data = AttributeUpdater().update(current_resource_data, new_resource_data)
+            logger.info('Updating resource ' + existing_resource_id)
+            response = await self.action('resource_update', updated_resource_data)
+        else:
+            check_required_attrs(data, RESOURCE_REQUIRED_ATTRS)
+
+            logger.info('Creating resource ' + new_resource_data['name'])
+            response = await self.action('resource_create', new_resource_data)
+
+        if response.ok:
+            return await self._upload_s3_resource(response.result.get('id', ''), s3_object_summary)
+        else:
+            return response
+
+    async def _upload_s3_resource(self, resource_id: str, s3_object_summary: 's3.ObjectSummary') -> CKANResponse:
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        filename = os.path.basename(s3_object_summary.key)
+        size = s3_object_summary.size
+        logger.info('Uploading resource {}, size {:.1f} MB from source {}'.format(
+            filename, size / 1024 / 1024, 's3://{}/{}'.format(s3_object_summary.bucket_name, s3_object_summary.key))
+        )
+
+        multipart_res = await self.action('cloudstorage_initiate_multipart',
+                                          dict(id=resource_id, name=filename, size=size))
+        if not multipart_res.ok:
+            return multipart_res
+        multipart_id = multipart_res.result['id']
+
+        chunk_size = self.part_size(size)
+        max_inflight_bytes = self.max_inflight_bytes or chunk_size * self.upload_workers
+        part_slots = asyncio.Semaphore(max(1, min(self.upload_workers, max_inflight_bytes // chunk_size)))
+        loop = asyncio.get_event_loop()
+        failed_parts = dict()
+
+        def read_part(offset, length):
+            body = s3_object_summary.meta.client.get_object(
+                Bucket=s3_object_summary.bucket_name,
+                Key=s3_object_summary.key,
+                Range='bytes={}-{}'.format(offset, offset + length - 1),
+                IfMatch=s3_object_summary.e_tag
+            )['Body']
+            return body.read()
+
+        async def upload_part(part_number, offset):
+            async with part_slots:
+                if failed_parts:
+                    return
+                try:
+                    chunk = await loop.run_in_executor(None, read_part, offset, min(chunk_size, size - offset))
+                    form = aiohttp.FormData()
+                    form.add_field('uploadId', str(multipart_id))
+                    form.add_field('partNumber', str(part_number))
+                    form.add_field('upload', chunk, filename='upload')
+                    fragment = await self.action('cloudstorage_upload_multipart', form=form)
+                    if fragment.ok:
+                        logger.info('Fragment #{} uploaded'.format(str(part_number)))
+                    else:
+                        failed_parts[part_number] = fragment.result
+                except (aiohttp.ClientError, asyncio.TimeoutError, BotoCoreError, ClientError) as e:
+                    logger.warning('Fragment #{} failed: {}'.format(part_number, e))
+                    failed_parts[part_number] = dict(message=str(e))
+
+        await asyncio.gather(*[
+            upload_part(part, offset) for part, offset in enumerate(range(0, size, chunk_size), start=1)
+        ])
+
+        if failed_parts:
+            logger.error('{} fragments failed for resource {}, aborting upload'.format(len(failed_parts), resource_id))
+            await self.action('cloudstorage_abort_multipart', dict(id=resource_id))
+            await self.action('resource_delete', dict(id=resource_id))
+            return _error_response('Multipart upload failed', failed_parts=failed_parts)
+
+        try:
+            res_finish = await self.action('cloudstorage_finish_multipart',
+                                           dict(id=resource_id, uploadId=multipart_id))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error('Could not finish upload of resource {}: {}'.format(resource_id, e))
+            res_finish = _error_response('Could not finish upload: {}'.format(e))
+
+        if not res_finish.ok and await self._upload_incomplete(resource_id):
+            await self.action('cloudstorage_abort_multipart', dict(id=resource_id))
+            await self.action('resource_delete', dict(id=resource_id))
+        return res_finish
+
+    async def _upload_incomplete(self, resource_id: str) -> bool:
+        # As in CKANEditor, a failed finish may still have completed, so only a resource cloudstorage still flags as
+        #  upload_in_progress is deleted
+        try:
+            res_show = await self.action('resource_show', params={'id': resource_id})
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning('Could not check the upload of resource {}: {}'.format(resource_id, e))
+            return False
+        return res_show.ok and str(res_show.result.get('upload_in_progress')).lower() == 'true'
+
+
+class AsyncCKANEditorSession(object):
+    def __init__(self, url=None, key=None, **editor_options):
+        if url is None or key is None:
+            raise UserException('The CKAN URL and/or API Key was not provided')
+
+        self.key = key
+        # Passed through to AsyncCKANEditor, eg max_concurrency=200
+        self.editor_options = editor_options
+        self.url = _api_action_url(url)
+
+    async def __aenter__(self):
+        self.ckaneditor = AsyncCKANEditor(self.url, self.key, **self.editor_options)
+        return self.ckaneditor
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.ckaneditor.close()
+        del self.ckaneditor
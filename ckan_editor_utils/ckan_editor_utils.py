@@ -1,93 +1,189 @@
 from urllib.parse import urlparse, quote
 
-import boto3
+import bisect
+import copy
 import functools
+import gzip
 import json
+import mmap
+import random
+import threading
+import time
+import uuid
 
-from botocore.exceptions import ClientError
-from io import BytesIO
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
 
 import requests
 import os
 import logging
 
+try:
+    # Optional; a BodyEncoder can serialise request bodies with it, as it is several times faster
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
 
+# Attributes CKAN needs before it will create a dataset, or that put_resource_from_s3 needs for a resource
+DATASET_REQUIRED_ATTRS = ('name', 'notes', 'owner_org', 'extra:identifier')
+RESOURCE_REQUIRED_ATTRS = ('name', 'resource:name', 'resource:description')
+
+
 class UserException(Exception):
     pass
 
 
+def check_required_attrs(data: dict, required_attrs, kind='Resource'):
+    for attr in required_attrs:
+        if attr not in data:
+            raise UserException('{} attribute missing: {}'.format(kind, attr))
+
+
 class CKANResponse(object):
+    # Bulk jobs create a great many of these, so the body is only parsed, and the log message only built,
+    #  once something actually needs them
+    __slots__ = ('response', 'status_code', '_ok', '_status', '_result', '_parsed', '_logged')
 
     def __init__(self, response: requests.models.Response):
 
         self.response = response
-        self._ok = False
-        self.status = None
         self.status_code = None
+        self._ok = False
+        self._status = None
+        self._result = None
+        self._parsed = False
+        self._logged = False
 
         if self.response is not None:
             self.status_code = self.response.status_code
 
+        # A failed HTTP status is always worth a warning; a success is only parsed here if it will be logged
+        if self.response is None or not self.response.ok or logger.isEnabledFor(logging.INFO):
+            self._log()
+
+    def _parse(self):
+        if self._parsed:
+            return
+        self._parsed = True
+        response = self.response
+
+        if response is not None:
+
             try:
-                self.result = response.json()
+                self._result = response.json()
 
             except Exception as e:
-                self.result = dict(message='{}: {}'.format(e, response.text.replace('\n', ' ')))
+                self._result = dict(message='{}: {}'.format(e, response.text.replace('\n', ' ')))
 
-            if self.response.ok and self.result.get('success'):
+            if response.ok and isinstance(self._result, dict) and self._result.get('success'):
                 self._ok = True
-                self.status = 'OK'
-                self.result = self.result.get('result')
+                self._status = 'OK'
+                self._result = self._result.get('result')
 
             else:
-                self.status = 'not OK'
+                self._status = 'not OK'
 
                 if self.status_code == 503:
-                    self.result = 'Service unavailable'
+                    self._result = 'Service unavailable'
 
                 if self.status_code == 403:
-                    self.result = 'Forbidden'
+                    self._result = 'Forbidden'
 
-                if isinstance(self.result, dict):
-                    err = self.result.get('error', {})
+                if isinstance(self._result, dict):
+                    err = self._result.get('error', {})
 
                     if err.get('name'):
-                        self.result = err.get('name', ['']).pop()
+                        self._result = err.get('name', ['']).pop()
 
                     elif err.get('id'):
-                        self.result = err.get('id', '')
+                        self._result = err.get('id', '')
 
                     elif err.get('message'):
-                        self.result = err.get('message', '')
+                        self._result = err.get('message', '')
 
                     elif err.get('__type') == 'Validation Error':
-                        self.result = err
+                        self._result = err
 
-            if isinstance(self.result, str):
-                self.result = dict(message=self.result)
+            if isinstance(self._result, str):
+                self._result = dict(message=self._result)
 
         else:
-            self.result = dict(result=None)
-            self.status_code = None
+            self._result = dict(result=None)
 
+        # An HTTP success that CKAN reports as a failure is still warned about, when it is found
+        if not self._ok and not self._logged:
+            self._log()
+
+    def _log(self):
+        self._logged = True
+        # The message (and any JSON dump of the result) is only formatted if a handler emits it
         if self.ok:
-            logger.info(str(self))
+            logger.info('%s', self)
         else:
-            logger.warning(str(self))
+            logger.warning('%s', self)
+
+    @classmethod
+    def from_result(cls, result):
+        # A successful response for metadata already held locally, so no CKAN call or log line is made
+        response = cls.__new__(cls)
+        response.response = None
+        response.status_code = None
+        response._ok = True
+        response._status = 'OK'
+        response._result = result
+        response._parsed = True
+        response._logged = True
+        return response
+
+    @classmethod
+    def from_error(cls, result):
+        # A failure found locally, eg a bad file or failed parts, warned about with its own message
+        response = cls.__new__(cls)
+        response.response = None
+        response.status_code = None
+        response._ok = False
+        response._status = 'not OK'
+        response._result = result
+        response._parsed = True
+        response._log()
+        return response
 
     @property
     def ok(self):
 
+        self._parse()
         return self._ok
 
     @ok.setter
     def ok(self, value: bool):
 
+        self._parse()
         if isinstance(value, bool):
             self._ok = value
 
+    @property
+    def status(self):
+
+        self._parse()
+        return self._status
+
+    @property
+    def result(self):
+
+        self._parse()
+        return self._result
+
+    @result.setter
+    def result(self, value):
+
+        self._parse()
+        self._result = value
+
     def __str__(self):
         if self.ok:
             return 'Response {} {}'.format(self.status_code, self.status)
@@ -95,93 +191,708 @@ class CKANResponse(object):
             return 'Response {} {}: {}'.format(self.status_code, self.status, json.dumps(self.result))
 
 
-def _urlencode_json(data: dict) -> str:
-    data_str = json.dumps(data, default=str)
-    data_enc = quote(data_str)
+def _error_response(message, **details) -> CKANResponse:
+    return CKANResponse.from_error(dict(message=message, **details))
+
+
+def _imap_unordered(func, iterable, max_workers):
+    # Only a bounded number of items are pulled ahead of the workers, so a generator is consumed lazily
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = dict()
+        for item in iterable:
+            pending[executor.submit(func, item)] = item
+
+            if len(pending) >= max_workers * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future
+
+        for future in as_completed(pending):
+            yield pending[future], future
+
+
+def _s3_resource():
+    # boto3 is slow to import and set up, so it is only loaded once S3 is actually used
+    import boto3
+    return boto3.session.Session().resource('s3')
+
+
+class _NoLock(object):
+    # Stands in for save_lock when nothing else writes to the dataset; contextlib.nullcontext needs Python 3.7
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+def _part_size(size, chunk_size, max_part_size, max_parts) -> int:
+    # The smallest fragment size that keeps the object within max_parts, rounded up to a whole MB
+    part_size = max(chunk_size, -(-size // max_parts))
+    part_size = -(-part_size // (1024 * 1024)) * 1024 * 1024
+    return max(chunk_size, min(part_size, max_part_size))
+
+
+def _check_upload_size(size, max_part_size, max_parts):
+    if size > max_part_size * max_parts:
+        raise UserException('Object of {} bytes is larger than {} parts of at most {} bytes'.format(
+            size, max_parts, max_part_size))
+
+
+def _resources_by_name(res_show):
+    # name -> resources with that name, so several resources can be matched against one package_show
+    resources_by_name = dict()
+    for cr in res_show.result.get('resources', []):
+        resources_by_name.setdefault(cr['name'], []).append(cr)
+    return resources_by_name
+
+
+def _s3_fingerprint(s3_object_summary):
+    # CKAN returns extra resource fields as strings, so they are stored and compared as strings
+    return {
+        's3_etag': s3_object_summary.e_tag,
+        's3_size': str(s3_object_summary.size),
+        's3_last_modified': str(s3_object_summary.last_modified),
+    }
+
+
+def _load_checkpoint(path):
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_checkpoint(path, checkpoint: dict):
+    # Write then rename, so a crash mid-write never leaves a truncated checkpoint behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def _orjson_default(o):
+    # Float subclasses, eg numpy.float64 from pandas rows, would otherwise be passed to str
+    if isinstance(o, float):
+        return float(o)
+    return str(o)
+
+
+def _dumps(data: dict, serializer='json') -> bytes:
+    if serializer == 'orjson' and orjson is not None:
+        try:
+            # Datetimes are passed to the default so they serialise the same as with json.dumps. NaN and infinities
+            #  still become null, as orjson only writes standard JSON
+            return orjson.dumps(data, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS |
+                                orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_SERIALIZE_NUMPY)
+        except TypeError:
+            # eg integers beyond 64 bits, which only json handles
+            pass
+    return json.dumps(data, default=str).encode()
+
+
+def _urlencode_json(data: dict, serializer='json') -> str:
+    data_enc = quote(_dumps(data, serializer))
     return data_enc
 
 
-def site_read(url, key):
-    response = requests.get(url + 'site_read', headers=dict(Authorization=key))
+class BodyEncoder(object):
+    # 'form' sends percent-encoded JSON as a form body, which every CKAN accepts, while 'json' sends the JSON as is,
+    #  which is smaller and cheaper to build. Bodies of gzip_threshold bytes or more are gzipped, for servers
+    #  or proxies that accept a gzip Content-Encoding on requests. serializer='orjson' uses orjson, if it is
+    #  installed, which is faster but writes NaN and infinities as null
+    modes = ('form', 'json')
+    serializers = ('json', 'orjson')
+
+    def __init__(self, mode='form', gzip_threshold=None, gzip_level=6, serializer='json'):
+        if mode not in self.modes:
+            raise UserException('Unknown body encoding {}, expected one of {}'.format(mode, self.modes))
+        if serializer not in self.serializers:
+            raise UserException('Unknown serializer {}, expected one of {}'.format(serializer, self.serializers))
+        self.mode = mode
+        self.gzip_threshold = gzip_threshold
+        self.gzip_level = gzip_level
+        self.serializer = serializer
+
+    def encode(self, data: dict):
+        # Returns the body and the headers that describe it
+        if self.mode == 'json':
+            body = _dumps(data, self.serializer)
+            headers = {'Content-Type': 'application/json'}
+        else:
+            body = _urlencode_json(data, self.serializer)
+            headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+        if self.gzip_threshold is not None and len(body) >= self.gzip_threshold:
+            body = gzip.compress(body.encode() if isinstance(body, str) else body, compresslevel=self.gzip_level)
+            headers['Content-Encoding'] = 'gzip'
+        return body, headers
+
+
+_default_encoder = BodyEncoder()
+
+
+class AdaptiveLimiter(object):
+    def __init__(self, initial=8, minimum=1, maximum=64, latency_target=None, decrease_factor=0.5):
+        # AIMD: the limit grows by about one per round of successful requests, and is cut by decrease_factor
+        #  when CKAN reports overload or requests take longer than latency_target seconds
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+
+        self._inflight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    @property
+    def inflight(self):
+
+        return self._inflight
+
+    def acquire(self):
+        with self._condition:
+            while self._inflight >= int(self.limit):
+                self._condition.wait()
+            self._inflight += 1
+
+    def release(self, latency: float, overloaded=False):
+        with self._condition:
+            self._inflight -= 1
+
+            if overloaded or (self.latency_target is not None and latency > self.latency_target):
+                now = time.monotonic()
+                # Requests already in flight will report the same congestion, so only back off once per round trip
+                if now - self._last_decrease >= latency:
+                    self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+            self._condition.notify_all()
+
+
+class RateLimiter(object):
+    def __init__(self, rate: float, burst=1):
+        # Caps how many requests start per second, allowing bursts of up to burst requests;
+        #  it can be passed anywhere an AdaptiveLimiter is accepted
+        self.rate = float(rate)
+        self.burst = burst
+
+        self._inflight = 0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def inflight(self):
+
+        return self._inflight
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Tokens are reserved before waiting, so concurrent callers queue up behind each other
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self._inflight += 1
+        if delay > 0:
+            time.sleep(delay)
+
+    def release(self, latency: float, overloaded=False):
+        with self._lock:
+            self._inflight -= 1
+
+
+def _never_sent(error: requests.exceptions.ConnectionError) -> bool:
+    # True when no connection could be made, so CKAN cannot have acted on the request
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.exceptions.ConnectTimeout) or \
+        isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+class CKANRetryAdapter(HTTPAdapter):
+    retry_statuses = (429, 503)
+    # A create that CKAN handled before its response was lost would be made twice if sent again
+    #  A finish that already completed fails when sent again, and the upload would then be treated as failed
+    non_idempotent_actions = frozenset(['package_create', 'resource_create', 'cloudstorage_initiate_multipart',
+                                        'cloudstorage_finish_multipart'])
+
+    def __init__(self, retries=3, backoff=0.5, max_backoff=30.0, limiter: AdaptiveLimiter = None,
+                 retry_creates=False, **kwargs):
+        # Retries overloaded responses and dropped connections with full-jitter exponential backoff. A 429 or a
+        #  connection that was never made is always retried, but creates are otherwise only retried with retry_creates
+        super().__init__(**kwargs)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limiter = limiter
+        self.retry_creates = retry_creates
+
+    def _idempotent(self, request) -> bool:
+        if self.retry_creates or request.method in ('GET', 'HEAD', 'OPTIONS'):
+            return True
+        return urlparse(request.url).path.rsplit('/', 1)[-1] not in self.non_idempotent_actions
+
+    def _delay(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+        if retry_after.isdigit():
+            return min(self.max_backoff, float(retry_after))
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def send(self, request, **kwargs):
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire()
+
+            start = time.monotonic()
+            overloaded = True
+            retry = False
+            try:
+                response = super().send(request, **kwargs)
+                overloaded = response.status_code in self.retry_statuses
+                retry = response.status_code == 429 or (overloaded and self._idempotent(request))
+            except requests.exceptions.ConnectionError as e:
+                if attempt >= self.retries or not (_never_sent(e) or self._idempotent(request)):
+                    raise
+                logger.warning('Connection to {} failed, retrying: {}'.format(request.url, e))
+                response = None
+                retry = True
+            finally:
+                if self.limiter is not None:
+                    self.limiter.release(time.monotonic() - start, overloaded)
+
+            if not retry or attempt >= self.retries:
+                # Picked up by the metrics sinks
+                response.retries = attempt
+                return response
+
+            delay = self._delay(attempt, response)
+            if response is not None:
+                logger.warning('Response {} from {}, retrying in {:.1f}s'.format(
+                    response.status_code, request.url, delay))
+                response.close()
+
+            attempt += 1
+            time.sleep(delay)
+
+
+def make_session(key=None, pool_size=10, keep_alive=True, retries=3, backoff=0.5,
+                 limiter: AdaptiveLimiter = None, retry_creates=False) -> requests.Session:
+    # One pooled session can be shared by every action call to reuse connections to CKAN
+    #  and to share retry and concurrency limits
+    session = requests.Session()
+    adapter = CKANRetryAdapter(retries=retries, backoff=backoff, limiter=limiter, retry_creates=retry_creates,
+                               pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    if key is not None:
+        session.headers['Authorization'] = key
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+ActionMetric = namedtuple('ActionMetric', [
+    'action', 'seconds', 'status_code', 'request_bytes', 'response_bytes', 'retries', 'part', 'encode_seconds'
+])
+
+# Objects with a record(metric) method; while this is empty no timing or sizing work is done at all
+_metrics_sinks = []
+
+
+def add_metrics_sink(sink):
+    if sink not in _metrics_sinks:
+        _metrics_sinks.append(sink)
+    return sink
+
+
+def remove_metrics_sink(sink):
+    if sink in _metrics_sinks:
+        _metrics_sinks.remove(sink)
+
+
+class CallbackSink(object):
+    def __init__(self, callback):
+        self.callback = callback
+
+    def record(self, metric: ActionMetric):
+        self.callback(metric)
+
+
+class HistogramSink(object):
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+    def __init__(self):
+        # Per action: [count, errors, seconds, request bytes, response bytes, retries, bucket counts]
+        self._actions = dict()
+        self._lock = threading.Lock()
+
+    def record(self, metric: ActionMetric):
+        with self._lock:
+            stats = self._actions.get(metric.action)
+            if stats is None:
+                stats = self._actions[metric.action] = [0, 0, 0.0, 0, 0, 0, [0] * len(self.buckets)]
+
+            stats[0] += 1
+            stats[1] += metric.status_code is None or metric.status_code >= 400
+            stats[2] += metric.seconds
+            stats[3] += metric.request_bytes
+            stats[4] += metric.response_bytes
+            stats[5] += metric.retries
+            stats[6][bisect.bisect_left(self.buckets, metric.seconds)] += 1
+
+    def _quantile(self, bucket_counts, count, q):
+        # Interpolated within the bucket holding the q-th observation, as Prometheus' histogram_quantile does
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(bucket_counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) - 1 else lower
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return 0.0
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                action: dict(
+                    count=count, errors=errors, retries=retries, seconds=seconds,
+                    request_bytes=request_bytes, response_bytes=response_bytes,
+                    mean=seconds / count,
+                    p50=self._quantile(bucket_counts, count, 0.5),
+                    p90=self._quantile(bucket_counts, count, 0.9),
+                    p99=self._quantile(bucket_counts, count, 0.99),
+                )
+                for action, (count, errors, seconds, request_bytes, response_bytes, retries, bucket_counts)
+                in self._actions.items()
+            }
+
+    def prometheus_text(self, prefix='ckan_action') -> str:
+        lines = ['# TYPE {}_seconds histogram'.format(prefix)]
+        with self._lock:
+            actions = sorted(self._actions.items())
+
+        for action, (count, errors, seconds, request_bytes, response_bytes, retries, bucket_counts) in actions:
+            cumulative = 0
+            for upper, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append('{}_seconds_bucket{{action="{}",le="{}"}} {}'.format(
+                    prefix, action, '+Inf' if upper == float('inf') else upper, cumulative))
+            lines.append('{}_seconds_sum{{action="{}"}} {}'.format(prefix, action, seconds))
+            lines.append('{}_seconds_count{{action="{}"}} {}'.format(prefix, action, count))
+
+        for name, position in [('errors', 1), ('request_bytes', 3), ('response_bytes', 4), ('retries', 5)]:
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, name))
+            for action, stats in actions:
+                lines.append('{}_{}_total{{action="{}"}} {}'.format(prefix, name, action, stats[position]))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _body_size(request) -> int:
+    if request is None or request.body is None:
+        return 0
+    if isinstance(request.body, (bytes, str)):
+        return len(request.body)
+    return int(request.headers.get('Content-Length', 0))
+
+
+def _record_metric(url, seconds, response, part=None, encode_seconds=0.0):
+    metric = ActionMetric(
+        action=url.rsplit('/', 1)[-1],
+        seconds=seconds,
+        status_code=response.status_code if response is not None else None,
+        request_bytes=_body_size(response.request) if response is not None else 0,
+        response_bytes=len(response.content) if response is not None else 0,
+        retries=getattr(response, 'retries', 0),
+        part=part,
+        encode_seconds=encode_seconds
+    )
+    for sink in list(_metrics_sinks):
+        try:
+            sink.record(metric)
+        except Exception as e:
+            logger.warning('Metrics sink {} failed: {}'.format(sink, e))
+
+
+def _request(method, url, key, session=None, part=None, encode_seconds=0.0, **kwargs) -> requests.models.Response:
+    # Fall back to the requests module so callers without a session keep working
+    http = session if session is not None else requests
+    headers = kwargs.pop('headers', {})
+    headers['Authorization'] = key
+
+    if not _metrics_sinks:
+        return http.request(method, url, headers=headers, **kwargs)
+
+    start = time.monotonic()
+    response = None
+    try:
+        response = http.request(method, url, headers=headers, **kwargs)
+        return response
+    finally:
+        _record_metric(url, time.monotonic() - start, response, part, encode_seconds)
+
+
+def _post_json(url, key, data, session=None, encoder: BodyEncoder = None) -> requests.models.Response:
+    encoder = encoder if encoder is not None else _default_encoder
+    if not _metrics_sinks:
+        body, headers = encoder.encode(data)
+        return _request('POST', url, key, session, data=body, headers=headers)
+
+    start = time.monotonic()
+    body, headers = encoder.encode(data)
+    return _request('POST', url, key, session, encode_seconds=time.monotonic() - start, data=body, headers=headers)
+
+
+def site_read(url, key, session=None):
+    response = _request('GET', url + 'site_read', key, session)
     return response
 
 
-def package_show(url, key, dataset_id):
+def package_show(url, key, dataset_id, session=None):
     logger.info('Showing dataset ' + dataset_id)
-    response = requests.get(url + 'package_show', params={'id': dataset_id}, headers=dict(Authorization=key))
+    response = _request('GET', url + 'package_show', key, session, params={'id': dataset_id})
     return response
 
 
-def package_query(url, key, query):
+def package_query(url, key, query, session=None):
     # query eg 'type:report'
     logger.info('Searching datasets for filtered query' + str(query))
-    response = requests.get(url + 'package_search', params={'fq': [query]}, headers=dict(Authorization=key))
+    response = _request('GET', url + 'package_search', key, session, params={'fq': [query]})
+    return response
+
+
+def package_search(url, key, params, session=None):
+    # params eg {'fq': 'organization:my-org', 'rows': 1000, 'start': 0}
+    logger.info('Searching datasets with ' + str(params))
+    response = _request('GET', url + 'package_search', key, session, params=params)
     return response
 
 
-def resource_show(url, key, resource_id):
+def package_query_iter(url, key, query=None, rows=1000, session=None, prefetch=True, **params):
+    # Yields every matching dataset, one page in memory at a time; the next page is fetched while this one is used
+    params.update(rows=rows)
+    params.setdefault('sort', 'name asc')
+    if query is not None:
+        params['fq'] = query
+
+    def fetch_page(start):
+        res_search = CKANResponse(package_search(url, key, dict(params, start=start), session=session))
+        if not res_search.ok:
+            raise UserException('Dataset search failed at row {}: {}'.format(start, res_search.result))
+        return res_search.result
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        start = 0
+        next_page = executor.submit(fetch_page, start)
+
+        while next_page is not None:
+            page = next_page.result()
+            start += rows
+            more = bool(page['results']) and start < page['count']
+
+            next_page = executor.submit(fetch_page, start) if more and prefetch else None
+            for dataset in page['results']:
+                yield dataset
+
+            if more and not prefetch:
+                next_page = executor.submit(fetch_page, start)
+
+
+def resource_show(url, key, resource_id, session=None):
     logger.info('Showing resource ' + resource_id)
-    response = requests.get(url + 'resource_show', params={'id': resource_id}, headers=dict(Authorization=key))
+    response = _request('GET', url + 'resource_show', key, session, params={'id': resource_id})
     return response
 
 
-def resource_delete(url, key, resource_id):
+def resource_delete(url, key, resource_id, session=None):
     logger.info('Deleting resource ' + resource_id)
-    response = requests.post(url + 'resource_delete', data={'id': resource_id}, headers=dict(Authorization=key))
+    response = _request('POST', url + 'resource_delete', key, session, data={'id': resource_id})
     return response
 
 
-def package_delete(url, key, dataset_id):
+def package_delete(url, key, dataset_id, session=None):
     logger.info('Deleting dataset ' + dataset_id)
-    response = requests.post(url + 'package_delete', data={'id': dataset_id}, headers=dict(Authorization=key))
+    response = _request('POST', url + 'package_delete', key, session, data={'id': dataset_id})
     return response
 
 
-def dataset_purge(url, key, dataset_id):
+def dataset_purge(url, key, dataset_id, session=None):
     logger.info('Purging dataset ' + dataset_id)
-    response = requests.post(url + 'dataset_purge', data={'id': dataset_id}, headers=dict(Authorization=key))
+    response = _request('POST', url + 'dataset_purge', key, session, data={'id': dataset_id})
     return response
 
 
-def package_create(url, key, data):
+def package_create(url, key, data, session=None, encoder=None):
     logger.info('Creating dataset ' + data['name'])
-    response = requests.post(url + 'package_create', data=_urlencode_json(data),
-                             headers={'Authorization': key,
-                                      'Content-Type': 'application/x-www-form-urlencoded'}
-                             )
+    response = _post_json(url + 'package_create', key, data, session, encoder)
     return response
 
 
-def package_update(url, key, data):
+def package_update(url, key, data, session=None, encoder=None):
     logger.info('Updating dataset ' + data['name'])
-    response = requests.post(url + 'package_update', data=_urlencode_json(data),
-                             headers={'Authorization': key,
-                                      'Content-Type': 'application/x-www-form-urlencoded'}
-                             )
+    response = _post_json(url + 'package_update', key, data, session, encoder)
+    return response
+
+
+def package_patch(url, key, data, session=None, encoder=None):
+    logger.info('Patching dataset ' + data['id'])
+    response = _post_json(url + 'package_patch', key, data, session, encoder)
     return response
 
 
-def resource_create(url, key, data):
+def _post_upload(url, key, data, upload, session=None) -> requests.models.Response:
+    # The attributes and file go in one multipart/form-data request, as CKAN expects for a direct upload
+    fields = {k: v for k, v in data.items() if v is not None}
+    body = MultipartBody(fields, 'upload', upload, filename=data.get('url') or 'upload')
+    return _request('POST', url, key, session, data=body, headers={'Content-Type': body.content_type})
+
+
+def resource_create(url, key, data, session=None, encoder=None, upload=None):
+    # upload is the file content (bytes or a memoryview) for a single request upload, instead of a multipart one
     logger.info('Creating resource ' + data['name'])
-    response = requests.post(url + 'resource_create', data=_urlencode_json(data),
-                             headers={'Authorization': key,
-                                      'Content-Type': 'application/x-www-form-urlencoded'}
-                             )
+    if upload is not None:
+        return _post_upload(url + 'resource_create', key, data, upload, session)
+    response = _post_json(url + 'resource_create', key, data, session, encoder)
     return response
 
 
-def resource_update(url, key, data):
+def resource_update(url, key, data, session=None, encoder=None):
     logger.info('Updating resource ' + data['id'])
-    response = requests.post(url + 'resource_update', data=_urlencode_json(data),
-                             headers={'Authorization': key,
-                                      'Content-Type': 'application/x-www-form-urlencoded'}
-                             )
+    response = _post_json(url + 'resource_update', key, data, session, encoder)
+    return response
+
+
+def resource_patch(url, key, data, session=None, encoder=None, upload=None):
+    logger.info('Patching resource ' + data['id'])
+    if upload is not None:
+        return _post_upload(url + 'resource_patch', key, data, upload, session)
+    response = _post_json(url + 'resource_patch', key, data, session, encoder)
+    return response
+
+
+def cloudstorage_initiate_multipart(url, key, resource_id, name, size, session=None, encoder=None):
+    logger.info('Initiating multipart upload for resource ' + resource_id)
+    response = _post_json(url + 'cloudstorage_initiate_multipart', key,
+                          dict(id=resource_id, name=name, size=size), session, encoder)
+    return response
+
+
+def cloudstorage_upload_multipart(url, key, upload_id, part_number, chunk, session=None):
+    # chunk can be bytes, a bytearray or a memoryview; it is sent as it is, without being copied into the body
+    body = MultipartBody(dict(uploadId=upload_id, partNumber=part_number), 'upload', chunk)
+    response = _request('POST', url + 'cloudstorage_upload_multipart', key, session,
+                        part=part_number,
+                        data=body,
+                        headers={'Content-Type': body.content_type})
     return response
 
 
+def cloudstorage_abort_multipart(url, key, resource_id, session=None):
+    logger.info('Aborting multipart upload for resource ' + resource_id)
+    response = _request('POST', url + 'cloudstorage_abort_multipart', key, session, data=dict(id=resource_id))
+    return response
+
+
+def cloudstorage_finish_multipart(url, key, resource_id, upload_id, session=None):
+    logger.info('Finishing multipart upload for resource ' + resource_id)
+    response = _request('POST', url + 'cloudstorage_finish_multipart', key, session,
+                        data=dict(id=resource_id, uploadId=upload_id))
+    return response
+
+
+class MultipartBody(object):
+    # A multipart/form-data body that is sent as its header, file data and trailer in turn, so the file data
+    #  never has to be joined into one bytes object. It can be iterated again when a request is retried
+    def __init__(self, fields: dict, file_field: str, file_data, filename='upload'):
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + boundary
+
+        def quote_name(name):
+            # As browsers do, so a quote in a name or filename cannot end the header value early
+            return str(name).replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+
+        head = ''.join('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+            boundary, quote_name(name), value) for name, value in fields.items())
+        head += ('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                 'Content-Type: application/octet-stream\r\n\r\n').format(
+            boundary, quote_name(file_field), quote_name(filename))
+        self._head = head.encode()
+        self._data = file_data
+        self._tail = '\r\n--{}--\r\n'.format(boundary).encode()
+
+    def __len__(self):
+        # Lets requests send a Content-Length rather than a chunked body
+        return len(self._head) + len(self._data) + len(self._tail)
+
+    def __iter__(self):
+        yield self._head
+        yield self._data
+        yield self._tail
+
+
+class BufferPool(object):
+    def __init__(self, count: int, size: int):
+        # Up to count buffers of size bytes, allocated on first use and then reused; acquire() waits for a free one,
+        #  so the pool never holds more than count x size bytes
+        self.count = count
+        self.size = size
+
+        self._free = []
+        self._allocated = 0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> bytearray:
+        with self._condition:
+            while not self._free and self._allocated >= self.count:
+                self._condition.wait()
+            if self._free:
+                return self._free.pop()
+            self._allocated += 1
+        return bytearray(self.size)
+
+    def release(self, buffer: bytearray):
+        with self._condition:
+            self._free.append(buffer)
+            self._condition.notify()
+
+
+def _readinto(stream, view: memoryview, piece_size=256 * 1024) -> int:
+    # Fills view from stream, which can take several reads. Some streams (eg urllib3's) read into a temporary bytes
+    #  and copy it in, so each read is kept to piece_size to keep that copy small. Streams without readinto
+    #  (eg from older botocore) are read and copied in the same pieces
+    filled = 0
+    readinto = getattr(stream, 'readinto', None)
+    while filled < len(view):
+        if readinto is not None:
+            count = readinto(view[filled:filled + piece_size])
+        else:
+            data = stream.read(min(piece_size, len(view) - filled))
+            count = len(data)
+            view[filled:filled + count] = data
+        if not count:
+            break
+        filled += count
+    return filled
+
+
 class AttributeUpdater(object):
     def __init__(self):
         self._edit_count = 0
+        self._changes = dict()
+
+    @property
+    def changes(self):
+        # Only the keys whose values were modified, with their new values
+
+        return self._changes
 
     @property
     def edit_count(self):
@@ -205,6 +916,7 @@ class AttributeUpdater(object):
                 logger.info(
                     'Modify "{}": {} -> {}'.format(key, str(data_to_update.get(key, ''))[:500], new_value))
                 updated_data[key] = new_value
+                self._changes[key] = new_value
                 self.edit_count += 1
 
         if self.edit_count > 0:
@@ -214,23 +926,158 @@ class AttributeUpdater(object):
             return data_to_update
 
 
+class MetadataCache(object):
+    def __init__(self, maxsize=1024, ttl=300):
+        # Least recently used entries are dropped beyond maxsize, and any entry older than ttl seconds is stale
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
 class CKANEditor(object):
-    def __init__(self, url, key):
+    def __init__(self, url, key, session=None, pool_size=10, keep_alive=True, retries=3, backoff=0.5, limiter=None,
+                 upload_workers=1, max_inflight_bytes=None, cache_size=0, cache_ttl=300, checkpoint_dir=None,
+                 s3_resource=None, patch_updates=False, encoder: BodyEncoder = None, chunk_size=1024 * 1024 * 5,
+                 max_part_size=1024 * 1024 * 1024 * 5, max_parts=10000, single_upload_max_size=0):
         self.url = url
         self.key = key
+        # Multipart fragments transferred at once, and the cap on bytes read but not yet uploaded
+        self.upload_workers = upload_workers
+        self.max_inflight_bytes = max_inflight_bytes
+        # The smallest multipart fragment; cloud storage backends usually require at least 5 MB for all but the last.
+        #  Larger objects use larger fragments, up to max_part_size, to stay within max_parts
+        self.chunk_size = chunk_size
+        self.max_part_size = max_part_size
+        self.max_parts = max_parts
+        # Objects up to this size are sent with the resource in a single request, skipping the multipart calls
+        self.single_upload_max_size = single_upload_max_size
+
+        # A session passed in is borrowed, otherwise this editor owns (and closes) its own pool
+        self._owns_session = session is None
+        if session is None:
+            session = make_session(key, max(pool_size, upload_workers), keep_alive, retries, backoff, limiter)
+        self.session = session
+
+        # Send only changed attributes through package_patch/resource_patch instead of full updates
+        self.patch_updates = patch_updates
+        # How create, update and patch bodies are sent; form-encoded JSON unless a BodyEncoder is given
+        self.encoder = encoder
+
+        # Built on the first S3 operation, so CKAN-only use never imports boto3
+        self._s3 = s3_resource
+        self._s3_lock = threading.Lock()
+
+        # Dataset name -> package_show result, only kept once build_index() has been called
+        self.index = None
+        # Recent package_show results, only kept when cache_size is set
+        self.cache = MetadataCache(cache_size, cache_ttl) if cache_size else None
+        # Dataset id -> name for the datasets held above, so a dataset can also be forgotten by its id
+        self._dataset_names = dict()
+
+        # Multipart upload progress is saved here so an interrupted upload can resume
+        self.checkpoint_dir = checkpoint_dir
+        if checkpoint_dir is not None:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+
+    @property
+    def s3(self):
+        if self._s3 is None:
+            with self._s3_lock:
+                if self._s3 is None:
+                    self._s3 = _s3_resource()
+        return self._s3
+
+    def close(self):
+        if self._owns_session:
+            self.session.close()
+
+    def build_index(self, query=None, organization=None, rows=1000) -> int:
+        # Page through package_search once so later calls can skip package_show for datasets found here
+        fq = [q for q in [query, 'organization:{}'.format(organization) if organization else None] if q]
+
+        index = dict()
+        for dataset in package_query_iter(self.url, self.key, ' AND '.join(fq) or None, rows=rows,
+                                          session=self.session, include_private=True):
+            index[dataset['name']] = dataset
+            self._dataset_names[dataset['id']] = dataset['name']
+
+        logger.info('Indexed {} datasets'.format(len(index)))
+        self.index = index
+        return len(index)
+
+    def _show_dataset(self, dataset_id) -> CKANResponse:
+        if self.index is not None and dataset_id in self.index:
+            return CKANResponse.from_result(copy.deepcopy(self.index[dataset_id]))
+
+        if self.cache is not None:
+            cached = self.cache.get(dataset_id)
+            if cached is not None:
+                logger.info('Using cached dataset ' + dataset_id)
+                return CKANResponse.from_result(copy.deepcopy(cached))
+
+        res_show = CKANResponse(package_show(self.url, self.key, dataset_id, session=self.session))
+        if res_show.ok and self.cache is not None:
+            self.cache.set(res_show.result['name'], copy.deepcopy(res_show.result))
+            self._dataset_names[res_show.result['id']] = res_show.result['name']
+        return res_show
+
+    def _remember_dataset(self, dataset: dict):
+        if self.index is not None:
+            self.index[dataset['name']] = dataset
+        if self.cache is not None:
+            self.cache.set(dataset['name'], copy.deepcopy(dataset))
+        if (self.index is not None or self.cache is not None) and 'id' in dataset:
+            self._dataset_names[dataset['id']] = dataset['name']
+
+    def _forget_dataset(self, dataset_id):
+        # dataset_id may be a name or an id, but the datasets are held by name
+        dataset_name = self._dataset_names.pop(dataset_id, dataset_id)
+        if self.index is not None:
+            self.index.pop(dataset_name, None)
+        if self.cache is not None:
+            self.cache.pop(dataset_name)
 
     def put_dataset(self, data, skip_existing=True) -> CKANResponse:
-        res_show = CKANResponse(package_show(self.url, self.key, data['name']))
+        res_show = self._show_dataset(data['name'])
 
         # either its not there and we create it, its there and we skip it, its there and we update it,
         if not res_show.ok:
 
-            required_attrs = ['name', 'notes', 'owner_org', 'extra:identifier']
-            for attr in required_attrs:
-                if attr not in data:
-                    raise UserException('Resource attribute missing: {}'.format(attr))
+            check_required_attrs(data, DATASET_REQUIRED_ATTRS, 'Dataset')
 
-            res_create = CKANResponse(package_create(self.url, self.key, data))
+            res_create = CKANResponse(package_create(self.url, self.key, data, session=self.session,
+                                                     encoder=self.encoder))
+            if res_create.ok:
+                self._remember_dataset(res_create.result)
             return res_create
 
         elif res_show.ok and skip_existing:
@@ -242,75 +1089,115 @@ class CKANEditor(object):
         au = AttributeUpdater()
         new_ckan_content = au.update(res_show.result, data)
 
-        if au.edit_count > 0:
+        if au.edit_count == 0:
+            logger.info('No change; update not requested')
+            return res_show
+
+        if self.patch_updates:
+            # Request size scales with the change rather than the dataset, and skips the organisation hotfix
+            patch = dict(au.changes, id=res_show.result['id'])
+            res_update = CKANResponse(package_patch(self.url, self.key, patch, session=self.session,
+                                                    encoder=self.encoder))
+        else:
             # hotfix to remove organisation markdown formatting that triggers firewall
             #  it will get replaced server-side by CKAN anyway
             new_ckan_content['organization'] = new_ckan_content['organization']['name']
 
-            res_update = CKANResponse(package_update(self.url, self.key, new_ckan_content))
-            return res_update
+            res_update = CKANResponse(package_update(self.url, self.key, new_ckan_content, session=self.session,
+                                                     encoder=self.encoder))
+
+        if res_update.ok:
+            self._remember_dataset(res_update.result)
         else:
-            logger.info('No change; update not requested')
-            return res_show
+            self._forget_dataset(data['name'])
+        return res_update
+
+    def put_datasets(self, datasets, skip_existing=True, max_workers=8):
+        # Yields (name, CKANResponse) as each dataset finishes, which may differ from the input order
+        def put(data):
+            try:
+                return self.put_dataset(data, skip_existing=skip_existing)
+            except Exception as e:
+                # Any error is reported against its dataset, so a bad one never stops the rest of the batch
+                logger.error('Dataset {} failed: {}'.format(data.get('name'), e))
+                return _error_response(str(e))
+
+        for data, future in _imap_unordered(put, datasets, max_workers):
+            yield data.get('name'), future.result()
+
+    def delete_dataset(self, dataset_id, delete_resources=True) -> CKANResponse:
+        # Returns the dataset_purge response, or the package_show response if the dataset could not be found
+        if not delete_resources:
+            # dataset_purge removes the resources with the dataset, so a single call is enough
+            logger.info('Purging dataset ' + dataset_id + ' with its resources')
+            res_purge = CKANResponse(dataset_purge(self.url, self.key, dataset_id, session=self.session))
+            self._forget_dataset(dataset_id)
+            return res_purge
 
-    def delete_dataset(self, dataset_id) -> CKANResponse:
         logger.info('Deleting and purging dataset ' + dataset_id + ' and its resources')
-        res_show = CKANResponse(package_show(self.url, self.key, dataset_id))
-        if res_show.ok:
-            for resource in res_show.result.get('resources', []):
-                CKANResponse(resource_delete(self.url, self.key, resource['id']))
+        res_show = self._show_dataset(dataset_id)
+        if not res_show.ok:
+            return res_show
+
+        # Each resource_delete rewrites the whole dataset in CKAN, so concurrent deletes could undo each other
+        for resource in res_show.result.get('resources', []):
+            if not CKANResponse(resource_delete(self.url, self.key, resource['id'], session=self.session)).ok:
+                logger.warning('Resource {} of dataset {} was not deleted'.format(resource['id'], dataset_id))
 
-            CKANResponse(package_delete(self.url, self.key, dataset_id))
-            CKANResponse(dataset_purge(self.url, self.key, dataset_id))
-        return CKANResponse(None)
+        CKANResponse(package_delete(self.url, self.key, dataset_id, session=self.session))
+        res_purge = CKANResponse(dataset_purge(self.url, self.key, dataset_id, session=self.session))
+        self._forget_dataset(res_show.result['name'])
+        return res_purge
 
-    def put_resource_from_s3(self, data: dict, s3_path: str, skip_existing=True) -> CKANResponse:
-        res_show = CKANResponse(package_show(self.url, self.key, data['name']))
+    def delete_datasets(self, dataset_ids, max_workers=8, delete_resources=False):
+        # Yields (id, CKANResponse) as each dataset finishes, which may differ from the input order
+        def delete(dataset_id):
+            try:
+                return self.delete_dataset(dataset_id, delete_resources=delete_resources)
+            except Exception as e:
+                logger.error('Dataset {} failed: {}'.format(dataset_id, e))
+                return _error_response(str(e))
 
-        current_resources = res_show.result.get('resources', [])
+        for dataset_id, future in _imap_unordered(delete, dataset_ids, max_workers):
+            yield dataset_id, future.result()
 
+    def _match_resource(self, resources_by_name: dict, data: dict, skip_existing: bool):
+        # Returns the matching resource's id ('' if there is none), its current data, and whether its upload is
+        #  resuming from a checkpoint; or None if the resource should be left alone
         existing_resource_id = ''
         current_resource_data = dict()
-        for cr in current_resources:
-            if cr['name'] == data['resource:name']:
-                if not existing_resource_id:
-                    current_resource_data = cr
-                    existing_resource_id = cr['id']
-                else:
-                    logger.warning('Multiple resources have been matched, skipping this update...')
-                    return res_show
-
-        if existing_resource_id:
+        matches = resources_by_name.get(data['resource:name'], [])
+        if len(matches) > 1:
+            logger.warning('Multiple resources have been matched, skipping this update...')
+            return None
+        elif matches:
+            current_resource_data = matches[0]
+            existing_resource_id = current_resource_data['id']
+
+        # A resource with an unfinished upload is never skipped, so the upload can resume
+        checkpoint_path = self._checkpoint_path(existing_resource_id) if existing_resource_id else None
+        resuming = bool(checkpoint_path and os.path.exists(checkpoint_path))
+        if resuming:
+            logger.info('Matched existing resource {} ({}) with an unfinished upload, resuming...'.format(
+                data['resource:name'], existing_resource_id))
+
+        elif existing_resource_id:
             # logger.info(
             #     'Matched existing resource {} ({})'.format(data['resource:name'], existing_resource_id))
             if skip_existing:
                 logger.info(
                     'Matched existing resource {} ({}), skipping...'.format(data['resource:name'], existing_resource_id)
                 )
-                return res_show
+                return None
             else:
                 logger.info(
                     'Matched existing resource {} ({}), updating...'.format(data['resource:name'], existing_resource_id)
                 )
 
-        s3r = boto3.resource('s3')
-
-        s3_path_parsed = urlparse(s3_path)
-        s3_bucket = s3_path_parsed.netloc
-        s3_key = s3_path_parsed.path[1:]  # Drop leading /
-
-        try:
-            s3_object_summary = s3r.ObjectSummary(
-                bucket_name=s3_bucket,
-                key=s3_key
-            )
-            # An exception will only trigger if missing attributes are requested
-            obj_name = os.path.basename(s3_object_summary.key)
-            obj_size = s3_object_summary.size
-        except ClientError as e:
-            logger.error('Invalid S3 object: {}'.format(e))
-            return CKANResponse(None)
+        return existing_resource_id, current_resource_data, resuming
 
+    def _save_resource(self, data: dict, existing_resource_id: str, current_resource_data: dict,
+                       obj_name: str, obj_size: int, upload=None, upload_attrs=None) -> CKANResponse:
         # Create or update resource
         new_resource_data = {
             'package_id': data['name'],
@@ -323,27 +1210,259 @@ class CKANEditor(object):
             'size': obj_size
         }
 
-        if existing_resource_id:
+        if upload is not None:
+            # The content is sent with the attributes, so the resource is complete after this one request
+            new_resource_data.update(upload_attrs or dict())
+            if existing_resource_id:
+                data['id'] = existing_resource_id
+                patch = dict(new_resource_data, id=existing_resource_id)
+                response = CKANResponse(resource_patch(self.url, self.key, patch, session=self.session, upload=upload))
+            else:
+                check_required_attrs(data, RESOURCE_REQUIRED_ATTRS)
+                response = CKANResponse(resource_create(self.url, self.key, new_resource_data, session=self.session,
+                                                        upload=upload))
+
+        elif existing_resource_id:
             data['id'] = existing_resource_id
-            updated_resource_data = AttributeUpdater().update(current_resource_data, new_resource_data)
-            response = CKANResponse(resource_update(self.url, self.key, updated_resource_data))
+            au = AttributeUpdater()
+            updated_resource_data = au.update(current_resource_data, new_resource_data)
+
+            if self.patch_updates and au.edit_count == 0:
+                response = CKANResponse.from_result(current_resource_data)
+            elif self.patch_updates:
+                patch = dict(au.changes, id=existing_resource_id)
+                response = CKANResponse(resource_patch(self.url, self.key, patch, session=self.session,
+                                                       encoder=self.encoder))
+            else:
+                response = CKANResponse(resource_update(self.url, self.key, updated_resource_data,
+                                                        session=self.session, encoder=self.encoder))
         else:
-            required_attrs = ['name', 'resource:name', 'resource:description']
-            for attr in required_attrs:
-                if attr not in data:
-                    raise UserException('Resource attribute missing: {}'.format(attr))
+            check_required_attrs(data, RESOURCE_REQUIRED_ATTRS)
+
+            response = CKANResponse(resource_create(self.url, self.key, new_resource_data, session=self.session,
+                                                    encoder=self.encoder))
+
+        # The dataset's resource list has changed, so the next lookup has to come from CKAN
+        self._forget_dataset(data['name'])
+        return response
+
+    def resolve_s3_objects(self, s3_paths, max_workers=8) -> dict:
+        # Looks up many s3:// paths with one paginated listing per prefix, rather than a request per object.
+        #  Returns s3_path -> ObjectSummary with its size, ETag and last-modified time already loaded,
+        #  leaving out any objects that were not found
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        wanted = dict()
+        for s3_path in s3_paths:
+            s3_path_parsed = urlparse(s3_path)
+            s3_key = s3_path_parsed.path[1:]
+            prefix = s3_key[:s3_key.rfind('/') + 1]
+            wanted.setdefault((s3_path_parsed.netloc, prefix), dict())[s3_key] = s3_path
+
+        s3r = self.s3
+        # The client is thread-safe, unlike the resource, so the prefixes are listed with it concurrently
+        s3_client = s3r.meta.client
+
+        def list_prefix(group):
+            (bucket, prefix), keys = group
+            first, last = min(keys), max(keys)
+            found = dict()
+            # Listings are sorted by key, so only the range between the first and last wanted key is read
+            pages = s3_client.get_paginator('list_objects_v2').paginate(
+                Bucket=bucket, Prefix=prefix, Delimiter='/', StartAfter=first[:-1])
+            try:
+                for page in pages:
+                    contents = page.get('Contents', [])
+                    for item in contents:
+                        if item['Key'] in keys:
+                            found[keys[item['Key']]] = item
+                    if len(found) == len(keys) or (contents and contents[-1]['Key'] >= last):
+                        break
+            except (BotoCoreError, ClientError) as e:
+                logger.warning('Listing s3://{}/{} failed: {}'.format(bucket, prefix, e))
+            return found
+
+        s3_objects = dict()
+        for ((bucket, _), _), future in _imap_unordered(list_prefix, wanted.items(), max_workers):
+            for s3_path, item in future.result().items():
+                s3_object_summary = s3r.ObjectSummary(bucket_name=bucket, key=item['Key'])
+                s3_object_summary.meta.data = item
+                s3_objects[s3_path] = s3_object_summary
+        return s3_objects
+
+    def put_resource_from_s3(self, data: dict, s3_path: str, skip_existing=True, skip_unchanged=False,
+                             s3_object_summary: 's3.ObjectSummary' = None, save_lock=None) -> CKANResponse:
+        # s3_object_summary can come from resolve_s3_objects(), which saves looking up the object again.
+        #  save_lock, if given, is held while the resource's metadata is written, so callers putting resources
+        #  into one dataset from several threads do not lose each other's changes
+        res_show = self._show_dataset(data['name'])
+
+        matched = self._match_resource(_resources_by_name(res_show), data, skip_existing)
+        if matched is None:
+            return res_show
+        return self._put_matched_resource_from_s3(data, s3_path, matched, skip_unchanged, s3_object_summary,
+                                                  save_lock)
+
+    def put_resources_from_s3(self, dataset_name: str, resources, skip_existing=True, skip_unchanged=False,
+                              max_workers=4):
+        # resources is a list of (resource data, s3_path) pairs for one dataset. The dataset is shown and the S3
+        #  objects are listed once for the whole batch, then the resources are put concurrently.
+        #  Yields (resource name, CKANResponse) as each finishes, which may differ from the input order
+        res_show = self._show_dataset(dataset_name)
+        if not res_show.ok:
+            for data, _ in resources:
+                yield data.get('resource:name'), res_show
+            return
+
+        resources_by_name = _resources_by_name(res_show)
+        batch_names = set()
+        matched_resources = []
+        for data, s3_path in resources:
+            data['name'] = dataset_name
+            try:
+                check_required_attrs(data, RESOURCE_REQUIRED_ATTRS)
+            except UserException as e:
+                yield data.get('resource:name'), _error_response(str(e))
+                continue
+
+            # Two entries with the same name would otherwise both create a resource, as neither exists yet
+            if data['resource:name'] in batch_names:
+                logger.warning('Resource {} appears more than once in this batch, skipping...'.format(
+                    data['resource:name']))
+                yield data['resource:name'], _error_response('Duplicate resource name: ' + data['resource:name'])
+                continue
+            batch_names.add(data['resource:name'])
+
+            matched = self._match_resource(resources_by_name, data, skip_existing)
+            if matched is None:
+                yield data['resource:name'], res_show
+            else:
+                matched_resources.append((data, s3_path, matched))
+
+        if not matched_resources:
+            return
+        s3_objects = self.resolve_s3_objects([s3_path for _, s3_path, _ in matched_resources], max_workers)
+        # CKAN rewrites the whole dataset on each resource change, so concurrent changes to one dataset can be
+        #  lost; only the metadata writes take turns, while the uploads still run concurrently
+        save_lock = threading.Lock()
+
+        def put(item):
+            data, s3_path, matched = item
+            try:
+                return self._put_matched_resource_from_s3(data, s3_path, matched, skip_unchanged,
+                                                          s3_objects.get(s3_path), save_lock)
+            except Exception as e:
+                # Any error is reported against its resource, so a bad one never stops the rest of the batch
+                logger.error('Resource {} failed: {}'.format(data['resource:name'], e))
+                return _error_response(str(e))
+
+        for (data, _, _), future in _imap_unordered(put, matched_resources, max_workers):
+            yield data['resource:name'], future.result()
 
-            response = CKANResponse(resource_create(self.url, self.key, new_resource_data))
+    def _put_matched_resource_from_s3(self, data: dict, s3_path: str, matched, skip_unchanged=False,
+                                      s3_object_summary: 's3.ObjectSummary' = None, save_lock=None) -> CKANResponse:
+        # save_lock, if given, is held while the resource's metadata is written
+        existing_resource_id, current_resource_data, resuming = matched
+        save_lock = save_lock or _NoLock()
 
-        if response.ok and s3_path is not None:
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        s3_path_parsed = urlparse(s3_path)
+        s3_bucket = s3_path_parsed.netloc
+        s3_key = s3_path_parsed.path[1:]  # Drop leading /
+
+        try:
+            if s3_object_summary is None:
+                s3_object_summary = self.s3.ObjectSummary(
+                    bucket_name=s3_bucket,
+                    key=s3_key
+                )
+            # An exception will only trigger if missing attributes are requested
+            obj_name = os.path.basename(s3_object_summary.key)
+            obj_size = s3_object_summary.size
+            fingerprint = _s3_fingerprint(s3_object_summary) if skip_unchanged else None
+        except (BotoCoreError, ClientError) as e:
+            logger.error('Invalid S3 object: {}'.format(e))
+            return _error_response('Invalid S3 object: {}'.format(e))
+
+        # Matching ETag, size and modification time mean CKAN already holds these bytes
+        unchanged = bool(fingerprint and existing_resource_id and not resuming and all(
+            str(current_resource_data.get(k)) == v for k, v in fingerprint.items()))
+
+        self._check_upload_size(obj_size)
+        if not unchanged and not resuming and self._single_upload(obj_size):
+            try:
+                content = s3_object_summary.meta.client.get_object(
+                    Bucket=s3_bucket, Key=s3_key, IfMatch=s3_object_summary.e_tag)['Body'].read()
+            except (BotoCoreError, ClientError) as e:
+                logger.error('Could not read S3 object: {}'.format(e))
+                return _error_response('Could not read S3 object: {}'.format(e))
+
+            # The fingerprint can go in the same request, as the content and attributes are saved together
+            with save_lock:
+                return self._save_resource(data, existing_resource_id, current_resource_data, obj_name, obj_size,
+                                           upload=content, upload_attrs=fingerprint)
+
+        with save_lock:
+            response = self._save_resource(data, existing_resource_id, current_resource_data, obj_name, obj_size)
+
+        if response.ok and unchanged:
+            logger.info('Content of resource {} is unchanged, skipping upload'.format(existing_resource_id))
+            return response
+
+        elif response.ok and s3_path is not None:
             # logger.info('An S3 path has been provided and will be uploaded')
-            resource = response.result
-            res_upload = self._upload_s3_resource(resource.get('id', ''), s3_object_summary)
+            resource_id = response.result.get('id', '')
+            res_upload = self._upload_s3_resource(resource_id, s3_object_summary, save_lock)
+
+            if res_upload.ok and fingerprint:
+                # Only recorded once the upload has finished, so a failed upload is never mistaken for a current one
+                with save_lock:
+                    res_patch = CKANResponse(resource_patch(self.url, self.key, dict(fingerprint, id=resource_id),
+                                                            session=self.session, encoder=self.encoder))
+                if not res_patch.ok:
+                    logger.warning('Could not record the S3 fingerprint of resource {}'.format(resource_id))
+
+            self._forget_dataset(data['name'])
             return res_upload
         else:
             return response
 
-    def _upload_s3_resource(self, resource_id: str, s3_object_summary: boto3.resource('s3').ObjectSummary) -> CKANResponse:
+    def put_resource_from_file(self, data: dict, file_path: str, skip_existing=True) -> CKANResponse:
+        res_show = self._show_dataset(data['name'])
+
+        matched = self._match_resource(_resources_by_name(res_show), data, skip_existing)
+        if matched is None:
+            return res_show
+        existing_resource_id, current_resource_data, resuming = matched
+
+        content = None
+        try:
+            obj_size = os.path.getsize(file_path)
+            self._check_upload_size(obj_size)
+            if not resuming and self._single_upload(obj_size):
+                with open(file_path, 'rb') as f:
+                    content = f.read()
+        except OSError as e:
+            logger.error('Invalid file: {}'.format(e))
+            return _error_response('Invalid file: {}'.format(e))
+
+        if content is not None:
+            return self._save_resource(data, existing_resource_id, current_resource_data,
+                                       os.path.basename(file_path), obj_size, upload=content)
+
+        response = self._save_resource(data, existing_resource_id, current_resource_data,
+                                       os.path.basename(file_path), obj_size)
+        if not response.ok:
+            return response
+
+        res_upload = self._upload_file_resource(response.result.get('id', ''), file_path)
+        self._forget_dataset(data['name'])
+        return res_upload
+
+    def _upload_s3_resource(self, resource_id: str, s3_object_summary: 's3.ObjectSummary',
+                            save_lock=None) -> CKANResponse:
+        from botocore.exceptions import BotoCoreError, ClientError
 
         filename = os.path.basename(s3_object_summary.key)
         logger.info('Uploading resource {}, size {:.1f} MB from source {}'.format(
@@ -352,75 +1471,277 @@ class CKANEditor(object):
             's3://{}/{}'.format(s3_object_summary.bucket_name, s3_object_summary.key))
         )
 
+        # The client is thread-safe, unlike the resource, so the workers share it for their ranged reads
+        s3_client = s3_object_summary.meta.client
+        s3_bucket = s3_object_summary.bucket_name
+        s3_key = s3_object_summary.key
+        s3_etag = s3_object_summary.e_tag
+
+        def read_part(offset, view):
+            # IfMatch stops parts being mixed from two versions of the object
+            body = s3_client.get_object(
+                Bucket=s3_bucket,
+                Key=s3_key,
+                Range='bytes={}-{}'.format(offset, offset + len(view) - 1),
+                IfMatch=s3_etag
+            )['Body']
+            try:
+                filled = _readinto(body, view)
+            finally:
+                body.close()
+            if filled < len(view):
+                raise IOError('S3 returned {} of {} bytes at offset {}'.format(filled, len(view), offset))
+
+        return self._upload_multipart(resource_id, filename, s3_object_summary.size, read_part, source_tag=s3_etag,
+                                      read_errors=(BotoCoreError, ClientError, IOError), readinto=True,
+                                      save_lock=save_lock)
+
+    def _upload_file_resource(self, resource_id: str, file_path: str) -> CKANResponse:
+        filename = os.path.basename(file_path)
+
+        with open(file_path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            logger.info('Uploading resource {}, size {:.1f} MB from source {}'.format(
+                filename, size / 1024 / 1024, file_path))
+
+            # Parts are slices of the mapping, so the file is paged in by the OS and never copied into Python objects
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+            view = memoryview(mapped)
+
+            def read_part(offset, length):
+                return view[offset:offset + length]
+
+            release_part = None
+            if size and hasattr(mmap, 'MADV_DONTNEED'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+                def release_part(offset, length):
+                    # Drops sent pages from this process, so RSS stays flat; they stay in the OS page cache
+                    mapped.madvise(mmap.MADV_DONTNEED, offset, length)
+
+            try:
+                # Size and modification time stand in for the S3 ETag when resuming from a checkpoint
+                return self._upload_multipart(resource_id, filename, size, read_part,
+                                              source_tag='{}-{}'.format(size, stat.st_mtime_ns), read_errors=(OSError,),
+                                              release_part=release_part)
+            finally:
+                view.release()
+                try:
+                    if size:
+                        mapped.close()
+                except BufferError:
+                    # A part is still referenced somewhere; the mapping is closed when that is collected
+                    pass
+
+    def part_size(self, size: int) -> int:
+        return _part_size(size, self.chunk_size, self.max_part_size, self.max_parts)
+
+    def _single_upload(self, size: int) -> bool:
+        return bool(self.single_upload_max_size) and size <= self.single_upload_max_size
+
+    def _check_upload_size(self, size: int):
+        _check_upload_size(size, self.max_part_size, self.max_parts)
+
+    def _checkpoint_path(self, resource_id):
+        if self.checkpoint_dir is None:
+            return None
+        return os.path.join(self.checkpoint_dir, '{}.json'.format(resource_id))
+
+    def _upload_incomplete(self, resource_id: str) -> bool:
+        # cloudstorage flags a resource as upload_in_progress from its initiate until its finish. A finish can fail
+        #  after completing, eg if its response is lost, so only a resource that is still flagged is known to be
+        #  incomplete and safe to delete
+        try:
+            res_show = CKANResponse(resource_show(self.url, self.key, resource_id, session=self.session))
+        except requests.exceptions.RequestException as e:
+            logger.warning('Could not check the upload of resource {}: {}'.format(resource_id, e))
+            return False
+        return res_show.ok and str(res_show.result.get('upload_in_progress')).lower() == 'true'
+
+    def _upload_multipart(self, resource_id: str, filename: str, size: int, read_part,
+                          source_tag=None, read_errors=(), release_part=None, readinto=False,
+                          save_lock=None) -> CKANResponse:
+        # read_part(offset, length) returns a part, or with readinto=True, read_part(offset, view) fills a buffer
+        #  from a pool that is reused for the whole upload. save_lock is held for the calls that can change the
+        #  dataset's metadata, but not while parts are transferred
+        chunk_size = self.part_size(size)
+        save_lock = save_lock or _NoLock()
+        send_parts = functools.partial(self._send_parts, resource_id, size, chunk_size, read_part,
+                                       read_errors=read_errors, release_part=release_part, readinto=readinto)
+
+        # The source tag (eg the S3 ETag) identifies the object version a checkpoint belongs to
+        checkpoint_path = self._checkpoint_path(resource_id) if source_tag else None
+        checkpoint = _load_checkpoint(checkpoint_path)
+
+        if checkpoint and [checkpoint['source_tag'], checkpoint['size'], checkpoint['chunk_size']] != \
+                [source_tag, size, chunk_size]:
+            logger.info('Source of resource {} changed since its checkpoint, restarting upload'.format(resource_id))
+            CKANResponse(cloudstorage_abort_multipart(self.url, self.key, resource_id, session=self.session))
+            os.remove(checkpoint_path)
+            checkpoint = None
+
+        if checkpoint:
+            logger.info('Resuming upload of resource {} with {} fragments already uploaded'.format(
+                resource_id, len(checkpoint['parts'])))
+            failed_parts = send_parts(checkpoint, checkpoint_path)
+            res_finish = None if failed_parts else self._finish_multipart(resource_id, checkpoint['multipart_id'],
+                                                                          save_lock)
+            if res_finish is not None and res_finish.ok:
+                os.remove(checkpoint_path)
+                return res_finish
+
+            # The multipart upload may have expired or been aborted, or even finished just before a crash kept the
+            #  checkpoint, so it is started again rather than resumed forever. The resource is kept either way
+            logger.warning('Resumed upload of resource {} failed, restarting it'.format(resource_id))
+            CKANResponse(cloudstorage_abort_multipart(self.url, self.key, resource_id, session=self.session))
+            os.remove(checkpoint_path)
+
         # initiate multipart upload
-        multipart_res = CKANResponse(
-            requests.post(url=self.url + 'cloudstorage_initiate_multipart',
-                          data=_urlencode_json(dict(id=resource_id, name=filename, size=s3_object_summary.size)),
-                          headers={'Authorization': self.key,
-                                   'Content-Type': 'application/x-www-form-urlencoded'}))
+        with save_lock:
+            multipart_res = CKANResponse(
+                cloudstorage_initiate_multipart(self.url, self.key, resource_id, filename, size,
+                                                session=self.session, encoder=self.encoder))
+        if not multipart_res.ok:
+            return multipart_res
 
         multipart_id = multipart_res.result['id']
+        checkpoint = dict(resource_id=resource_id, source_tag=source_tag, size=size, chunk_size=chunk_size,
+                          multipart_id=multipart_id, parts=[])
+        if checkpoint_path:
+            _save_checkpoint(checkpoint_path, checkpoint)
+
+        failed_parts = send_parts(checkpoint, checkpoint_path)
+        if failed_parts and checkpoint_path:
+            # Leave the multipart upload and resource in place so a later call can resume from the checkpoint
+            logger.error('{} fragments failed for resource {}, checkpoint kept at {}'.format(
+                len(failed_parts), resource_id, checkpoint_path))
+            return _error_response('Multipart upload failed', failed_parts=failed_parts, checkpoint=checkpoint_path)
+
+        elif failed_parts:
+            logger.error('{} fragments failed for resource {}, aborting upload'.format(len(failed_parts), resource_id))
+            CKANResponse(cloudstorage_abort_multipart(self.url, self.key, resource_id, session=self.session))
+            with save_lock:
+                CKANResponse(resource_delete(self.url, self.key, resource_id, session=self.session))
+
+            return _error_response('Multipart upload failed', failed_parts=failed_parts)
+
+        res_finish = self._finish_multipart(resource_id, multipart_id, save_lock)
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        if not res_finish.ok and self._upload_incomplete(resource_id):
+            CKANResponse(cloudstorage_abort_multipart(self.url, self.key, resource_id, session=self.session))
+            with save_lock:
+                CKANResponse(resource_delete(self.url, self.key, resource_id, session=self.session))
+        return res_finish
+
+    def _send_parts(self, resource_id: str, size: int, chunk_size: int, read_part, checkpoint: dict,
+                    checkpoint_path=None, read_errors=(), release_part=None, readinto=False) -> dict:
+        # Uploads the parts not yet in the checkpoint, recording each one as it completes, and returns the failed
+        #  parts by part number
+        multipart_id = checkpoint['multipart_id']
+        completed_parts = set(checkpoint['parts'])
+        checkpoint_lock = threading.Lock()
+
+        # Each worker fetches, uploads and frees one part at a time, so in-flight bytes are bounded by the pool size
+        max_inflight_bytes = self.max_inflight_bytes or chunk_size * self.upload_workers
+        workers = max(1, min(self.upload_workers, max_inflight_bytes // chunk_size))
+        failed_parts = dict()
+        buffers = BufferPool(workers, chunk_size) if readinto else None
+
+        def upload_part(part_number, offset):
+            if failed_parts:
+                # No point transferring the rest of the object once the upload is known to be incomplete
+                return
+            buffer = buffers.acquire() if buffers is not None else None
+            try:
+                if buffer is not None:
+                    chunk = memoryview(buffer)[:min(chunk_size, size - offset)]
+                    read_part(offset, chunk)
+                else:
+                    chunk = read_part(offset, min(chunk_size, size - offset))
+                fragment = CKANResponse(
+                    cloudstorage_upload_multipart(self.url, self.key, multipart_id, part_number, chunk,
+                                                  session=self.session)
+                )
+                if fragment.ok:
+                    logger.info('Fragment #{} uploaded'.format(str(part_number)))
+                    if checkpoint_path:
+                        with checkpoint_lock:
+                            checkpoint['parts'].append(part_number)
+                            _save_checkpoint(checkpoint_path, checkpoint)
+                else:
+                    failed_parts[part_number] = fragment.result
+            except (requests.exceptions.RequestException,) + read_errors as e:
+                logger.warning('Fragment #{} failed: {}'.format(part_number, e))
+                failed_parts[part_number] = dict(message=str(e))
+            finally:
+                if buffer is not None:
+                    buffers.release(buffer)
+                if release_part is not None:
+                    release_part(offset, min(chunk_size, size - offset))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict()
+            for part, offset in enumerate(range(0, size, chunk_size), start=1):
+                if part not in completed_parts:
+                    futures[executor.submit(upload_part, part, offset)] = part
+
+            # An unexpected error must still fail its part, or the upload would be finished without it
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    logger.warning('Fragment #{} failed: {}'.format(futures[future], future.exception()))
+                    failed_parts[futures[future]] = dict(message=str(future.exception()))
+
+        if failed_parts:
+            logger.warning('{} fragments failed for resource {}'.format(len(failed_parts), resource_id))
+        return failed_parts
+
+    def _finish_multipart(self, resource_id: str, multipart_id: str, save_lock) -> CKANResponse:
+        try:
+            with save_lock:
+                return CKANResponse(
+                    cloudstorage_finish_multipart(self.url, self.key, resource_id, multipart_id, session=self.session)
+                )
+        except requests.exceptions.RequestException as e:
+            logger.error('Could not finish upload of resource {}: {}'.format(resource_id, e))
+            return _error_response('Could not finish upload: {}'.format(e))
 
-        part = 0
-        chunk_size = 1024 * 1024 * 5
-        data_obj_body = s3_object_summary.get()["Body"]
 
-        chunker = functools.partial(data_obj_body.read, chunk_size)
+def _api_action_url(url):
+    url_parsed = urlparse(url)
 
-        for chunk in iter(chunker, b''):
-            part += 1
-            fragment = CKANResponse(
-                requests.post(
-                    url=self.url + 'cloudstorage_upload_multipart',
-                    data=dict(uploadId=multipart_id, partNumber=part),
-                    files=dict(upload=BytesIO(chunk)),
-                    headers=dict(Authorization=self.key)
-                )
-            )
-            if fragment.ok:
-                logger.info('Fragment #{} uploaded'.format(str(part)))
-            else:
-                logger.info(fragment.result)
-
-        res_finish = CKANResponse(
-            requests.post(
-                url=self.url + 'cloudstorage_finish_multipart',
-                data=dict(id=resource_id, uploadId=multipart_id),
-                headers=dict(Authorization=self.key)
-            )
-        )
+    # Use start and end because it may contain an optional version number
+    if url_parsed.path.startswith('/api/') and url_parsed.path.endswith('/action/'):
+        action_url = url
+    elif url_parsed.path == '':
+        action_url = url + '/api/action/'
+    elif url_parsed.path == '/':
+        action_url = url + 'api/action/'
+    else:
+        raise UserException('The CKAN URL provided is not valid')
 
-        if not res_finish.ok:
-            CKANResponse(resource_delete(self.url, self.key, resource_id))
-        return res_finish
+    if url_parsed.params + url_parsed.query + url_parsed.fragment != '':
+        raise UserException('The CKAN URL provided is not valid')
+    return action_url
 
 
 class CKANEditorSession(object):
-    def __init__(self, url=None, key=None):
+    def __init__(self, url=None, key=None, **editor_options):
         if url is None or key is None:
             raise UserException('The CKAN URL and/or API Key was not provided')
 
         self.key = key
-        url_parsed = urlparse(url)
-
-        # Use start and end because it may contain an optional version number
-        if url_parsed.path.startswith('/api/') and url_parsed.path.endswith('/action/'):
-            self.url = url
-        elif url_parsed.path == '':
-            self.url = url + '/api/action/'
-        elif url_parsed.path == '/':
-            self.url = url + 'api/action/'
-        else:
-            raise UserException('The CKAN URL provided is not valid')
-
-        if url_parsed.params + url_parsed.query + url_parsed.fragment != '':
-            raise UserException('The CKAN URL provided is not valid')
+        # Passed through to CKANEditor, eg pool_size=20 or keep_alive=False
+        self.editor_options = editor_options
+        self.url = _api_action_url(url)
 
     def __enter__(self):
-        self.ckaneditor = CKANEditor(self.url, self.key)
+        self.ckaneditor = CKANEditor(self.url, self.key, **self.editor_options)
         return self.ckaneditor
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.ckaneditor.close()
         del self.ckaneditor
 
 
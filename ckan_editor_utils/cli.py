@@ -0,0 +1,215 @@
+"""Bulk CKAN edits from a JSON lines or CSV manifest.
+
+Each manifest record is a dataset, optionally with one resource to upload from S3, eg
+    {"name": "ds000001", "notes": "...", "owner_org": "my-org", "extra:identifier": "DS000001",
+     "resource:name": "Data", "resource:description": "...", "s3_path": "s3://mybucket/data.zip"}
+
+Commands:
+    put       create or update each dataset, then upload its resource if the record has an s3_path
+    upload    upload only the resources, into datasets that already exist
+    delete    purge each dataset named by the record's id or name
+
+The URL and API key can also be set with the CKAN_URL and CKAN_API_KEY environment variables.
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+from . import ckan_editor_utils
+from .ckan_editor_utils import _error_response
+from .pipeline import Pipeline, parse_record, read_csv, read_jsonl, read_records
+
+logger = logging.getLogger(__name__)
+
+
+class _Progress(object):
+    # Counts finished items and uploaded bytes, and prints a running summary line
+    def __init__(self, stream=sys.stderr, interval=2.0):
+        self.stream = stream
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.uploaded_bytes = 0
+        self.start = time.monotonic()
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def record(self, ok: bool):
+        with self._lock:
+            self.done += 1
+            self.failed += not ok
+
+    def record_metric(self, metric: ckan_editor_utils.ActionMetric):
+        # Only multipart fragments count towards upload throughput
+        if metric.part is not None and metric.status_code is not None and metric.status_code < 400:
+            with self._lock:
+                self.uploaded_bytes += metric.request_bytes
+
+    def summary(self) -> str:
+        seconds = max(time.monotonic() - self.start, 1e-9)
+        return '{} done, {} failed in {:.0f}s, {:.1f} items/s, {:.1f} MB/s uploaded'.format(
+            self.done, self.failed, seconds, self.done / seconds, self.uploaded_bytes / 1024 / 1024 / seconds)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.stream.write('\r' + self.summary())
+            self.stream.flush()
+
+    def __enter__(self):
+        if self.interval > 0:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.stream.write('\r' + self.summary() + '\n')
+        self.stream.flush()
+
+
+def _records(args, parse=True):
+    # With parse=False, JSON lines are left for the Pipeline to parse, so a malformed line fails only that record
+    if args.manifest == '-':
+        return read_csv(sys.stdin) if args.format == 'csv' else read_jsonl(sys.stdin, parse=parse)
+    if args.format == 'csv':
+        return read_csv(args.manifest)
+    if args.format == 'jsonl':
+        return read_jsonl(args.manifest, parse=parse)
+    return read_records(args.manifest, parse=parse)
+
+
+def _report_failure(name, response: ckan_editor_utils.CKANResponse, stage=None):
+    logger.error('{}{} failed: {}'.format(stage + ' ' if stage else '', name, response.result))
+
+
+def run_put(editor, args, progress: _Progress, put_datasets=True):
+    pipeline = Pipeline(editor, dataset_workers=args.workers, resource_workers=args.resource_workers,
+                        queue_size=args.queue_size, skip_existing=not args.update,
+                        skip_unchanged=args.skip_unchanged, put_datasets=put_datasets)
+    for result in pipeline.run(_records(args, parse=False)):
+        progress.record(result.response.ok)
+        if not result.response.ok:
+            _report_failure(result.name if result.resource_name is None else
+                            '{}/{}'.format(result.name, result.resource_name), result.response, result.stage)
+
+
+def _dataset_ids(records, progress: _Progress):
+    # Each record is checked as it is read, so a bad one is counted as a failure without stopping the deletes
+    #  already under way
+    for record in records:
+        try:
+            record = parse_record(record)
+            dataset_id = record.get('id') or record.get('name')
+            if not dataset_id:
+                raise ckan_editor_utils.UserException('Record has neither an id nor a name')
+        except (ValueError, ckan_editor_utils.UserException) as e:
+            progress.record(False)
+            _report_failure('Record', _error_response('Invalid record: {}'.format(e)), 'read')
+            continue
+        yield dataset_id
+
+
+def run_delete(editor, args, progress: _Progress):
+    dataset_ids = _dataset_ids(_records(args, parse=False), progress)
+    for dataset_id, response in editor.delete_datasets(dataset_ids, max_workers=args.workers,
+                                                       delete_resources=args.delete_resources):
+        progress.record(response.ok)
+        if not response.ok:
+            _report_failure(dataset_id, response)
+
+
+COMMANDS = {
+    'put': run_put,
+    'upload': lambda editor, args, progress: run_put(editor, args, progress, put_datasets=False),
+    'delete': run_delete,
+}
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='ckan-editor-utils', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=sorted(COMMANDS))
+    parser.add_argument('manifest', help='JSON lines or CSV file, or - to read from stdin')
+    parser.add_argument('--url', default=os.environ.get('CKAN_URL'), help='CKAN site or action API URL')
+    parser.add_argument('--key', default=os.environ.get('CKAN_API_KEY'), help='CKAN API key')
+    parser.add_argument('--format', choices=['auto', 'csv', 'jsonl'], default='auto',
+                        help='manifest format; auto picks CSV for .csv files and JSON lines otherwise')
+
+    parallelism = parser.add_argument_group('parallelism')
+    parallelism.add_argument('--workers', type=int, default=8, help='datasets put or deleted at once')
+    parallelism.add_argument('--resource-workers', type=int, default=2, help='resources uploaded at once')
+    parallelism.add_argument('--upload-workers', type=int, default=1, help='fragments of each upload sent at once')
+    parallelism.add_argument('--chunk-size-mb', type=int, default=5,
+                             help='smallest multipart fragment; larger objects use larger fragments')
+    parallelism.add_argument('--max-part-size-mb', type=int, default=5 * 1024, help='largest multipart fragment')
+    parallelism.add_argument('--max-parts', type=int, default=10000, help='most fragments in one upload')
+    parallelism.add_argument('--single-upload-mb', type=float, default=0,
+                             help='send objects up to this size with the resource in one request')
+    parallelism.add_argument('--max-inflight-mb', type=int, default=None,
+                             help='cap on fragment data held in memory by each upload')
+    parallelism.add_argument('--rate-limit', type=float, default=None, help='maximum CKAN requests per second')
+    parallelism.add_argument('--queue-size', type=int, default=100, help='records waiting between stages')
+    parallelism.add_argument('--retries', type=int, default=3, help='retries for overloaded or dropped requests')
+
+    behaviour = parser.add_argument_group('behaviour')
+    behaviour.add_argument('--update', action='store_true',
+                           help='update existing datasets and resources instead of skipping them')
+    behaviour.add_argument('--skip-unchanged', action='store_true',
+                           help='with --update, skip uploading S3 objects that have not changed')
+    behaviour.add_argument('--patch', action='store_true', help='send only changed attributes when updating')
+    behaviour.add_argument('--json-bodies', action='store_true', help='send request bodies as application/json')
+    behaviour.add_argument('--delete-resources', action='store_true',
+                           help='delete resources one by one before purging each dataset')
+    behaviour.add_argument('--checkpoint-dir', default=None, help='save upload progress here so uploads can resume')
+    behaviour.add_argument('--cache-size', type=int, default=10000, help='datasets kept in the metadata cache')
+
+    output = parser.add_argument_group('output')
+    output.add_argument('--progress-interval', type=float, default=2.0,
+                        help='seconds between progress lines, or 0 for only the final summary')
+    output.add_argument('--log-level', default='ERROR', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    return parser
+
+
+def main(argv=None) -> int:
+    args = make_parser().parse_args(argv)
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    if args.url is None or args.key is None:
+        raise SystemExit('The CKAN URL and API key must be given with --url and --key, or CKAN_URL and CKAN_API_KEY')
+
+    editor_options = dict(
+        pool_size=args.workers + args.resource_workers * args.upload_workers,
+        retries=args.retries,
+        limiter=ckan_editor_utils.RateLimiter(args.rate_limit) if args.rate_limit else None,
+        upload_workers=args.upload_workers,
+        max_inflight_bytes=args.max_inflight_mb * 1024 * 1024 if args.max_inflight_mb else None,
+        chunk_size=args.chunk_size_mb * 1024 * 1024,
+        max_part_size=args.max_part_size_mb * 1024 * 1024,
+        max_parts=args.max_parts,
+        single_upload_max_size=int(args.single_upload_mb * 1024 * 1024),
+        cache_size=args.cache_size,
+        checkpoint_dir=args.checkpoint_dir,
+        patch_updates=args.patch,
+        encoder=ckan_editor_utils.BodyEncoder('json') if args.json_bodies else None,
+    )
+
+    progress = _Progress(interval=args.progress_interval)
+    sink = ckan_editor_utils.add_metrics_sink(ckan_editor_utils.CallbackSink(progress.record_metric))
+    try:
+        with ckan_editor_utils.CKANEditorSession(args.url, args.key, **editor_options) as editor, progress:
+            COMMANDS[args.command](editor, args, progress)
+    finally:
+        ckan_editor_utils.remove_metrics_sink(sink)
+
+    return 1 if progress.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
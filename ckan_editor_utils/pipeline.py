@@ -0,0 +1,233 @@
+from collections import namedtuple
+
+import csv
+import json
+import logging
+import queue
+import threading
+
+from .ckan_editor_utils import (RESOURCE_REQUIRED_ATTRS, CKANEditor, CKANResponse, UserException, _error_response,
+                                check_required_attrs)
+
+logger = logging.getLogger(__name__)
+
+# stage is one of 'read', 'validate', 'dataset' or 'resource'; resource_name is None for dataset-only records
+PipelineResult = namedtuple('PipelineResult', ['stage', 'name', 'resource_name', 'response'])
+
+_DONE = object()
+
+
+def _open(source, newline=None):
+    # A path is opened here, anything else is taken to be an open text file
+    if isinstance(source, str):
+        return open(source, newline=newline)
+    return source
+
+
+def read_jsonl(source, parse=True):
+    # Yields one dict per non-blank line, so the manifest is never held in memory all at once. With parse=False the
+    #  lines are yielded as text instead, so Pipeline can report a malformed line without ending the whole read
+    f = _open(source)
+    try:
+        for line in f:
+            if line.strip():
+                yield json.loads(line) if parse else line
+    finally:
+        if f is not source:
+            f.close()
+
+
+def read_csv(source):
+    # Empty cells are dropped, so a blank column never overwrites an existing attribute
+    f = _open(source, newline='')
+    try:
+        for row in csv.DictReader(f):
+            yield {k: v for k, v in row.items() if k and v not in ('', None)}
+    finally:
+        if f is not source:
+            f.close()
+
+
+def read_records(source, parse=True):
+    # Picks the reader by file extension, treating anything that is not .csv as JSON lines
+    name = source if isinstance(source, str) else getattr(source, 'name', '')
+    if str(name).lower().endswith('.csv'):
+        return read_csv(source)
+    return read_jsonl(source, parse=parse)
+
+
+def parse_record(record) -> dict:
+    # JSON lines read with parse=False are parsed here, so a malformed line only fails its own record
+    if isinstance(record, str):
+        record = json.loads(record)
+    if not isinstance(record, dict):
+        raise UserException('Record is not an object: {}'.format(str(record)[:100]))
+    return record
+
+
+def split_record(record: dict):
+    # One manifest row can describe a dataset and one of its resources, eg a CSV with both name and resource:name
+    dataset = {k: v for k, v in record.items() if not k.startswith('resource:') and k != 's3_path'}
+    if 's3_path' not in record:
+        return dataset, None, None
+
+    resource = {k: v for k, v in record.items() if k.startswith('resource:')}
+    resource['name'] = record['name']
+    return dataset, resource, record['s3_path']
+
+
+class Pipeline(object):
+    def __init__(self, editor: CKANEditor, dataset_workers=8, resource_workers=2, queue_size=100,
+                 skip_existing=True, skip_unchanged=False, put_datasets=True):
+        self.editor = editor
+        self.dataset_workers = dataset_workers
+        self.resource_workers = resource_workers
+        # Each stage holds at most this many records waiting, so a slow stage holds back the ones before it
+        self.queue_size = queue_size
+        self.skip_existing = skip_existing
+        self.skip_unchanged = skip_unchanged
+        # With put_datasets=False the datasets are assumed to exist, and only the resources are put
+        self.put_datasets = put_datasets
+
+        # Records for the same dataset are put one at a time, so two rows never both try to create it. CKAN rewrites
+        #  the whole dataset for each resource change too, so resource writes take the same lock
+        self._dataset_locks = [threading.Lock() for _ in range(64)]
+
+    def _dataset_lock(self, name: str) -> threading.Lock:
+        return self._dataset_locks[hash(name) % len(self._dataset_locks)]
+
+    @staticmethod
+    def _parse(record) -> dict:
+        return parse_record(record)
+
+    def _validate(self, record: dict):
+        check_required_attrs(record, ('name',), 'Dataset')
+        if 's3_path' in record:
+            check_required_attrs(record, RESOURCE_REQUIRED_ATTRS)
+        elif not self.put_datasets:
+            check_required_attrs(record, ('s3_path',))
+
+    def _put_dataset(self, dataset: dict) -> CKANResponse:
+        with self._dataset_lock(dataset['name']):
+            return self.editor.put_dataset(dataset, skip_existing=self.skip_existing)
+
+    def _put_resource(self, resource: dict, s3_path: str) -> CKANResponse:
+        # Only the metadata writes hold the lock, so uploads into one dataset still run concurrently
+        return self.editor.put_resource_from_s3(resource, s3_path, skip_existing=self.skip_existing,
+                                                skip_unchanged=self.skip_unchanged,
+                                                save_lock=self._dataset_lock(resource['name']))
+
+    def run(self, records):
+        # Yields a PipelineResult for each record and stage as it finishes, which may differ from the input order
+        datasets = queue.Queue(self.queue_size)
+        resources = queue.Queue(self.queue_size)
+        results = queue.Queue(self.queue_size)
+        stop = threading.Event()
+
+        def put(q, item):
+            # Waits while q is full, but gives up once the caller has stopped reading results
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def attempt(func, *args):
+            try:
+                return func(*args)
+            except Exception as e:
+                # Any error is reported against its record, so a bad row never stops the rest of the run
+                logger.error('Pipeline step failed: {}'.format(e))
+                return _error_response(str(e))
+
+        def read():
+            try:
+                for record in records:
+                    if stop.is_set():
+                        break
+                    try:
+                        record = self._parse(record)
+                    except Exception as e:
+                        put(results, PipelineResult('read', None, None,
+                                                    _error_response('Invalid record: {}'.format(e))))
+                        continue
+
+                    try:
+                        self._validate(record)
+                    except Exception as e:
+                        put(results, PipelineResult('validate', record.get('name'), record.get('resource:name'),
+                                                    _error_response(str(e))))
+                        continue
+                    put(datasets, record)
+            except Exception as e:
+                logger.error('Reading records failed: {}'.format(e))
+                put(results, PipelineResult('read', None, None, _error_response(str(e))))
+
+        def dataset_worker():
+            while True:
+                record = datasets.get()
+                if record is _DONE:
+                    return
+                if stop.is_set():
+                    continue
+
+                dataset, resource, s3_path = split_record(record)
+                if not self.put_datasets:
+                    put(resources, (resource, s3_path))
+                    continue
+
+                res_dataset = attempt(self._put_dataset, dataset)
+                put(results, PipelineResult('dataset', dataset['name'], None, res_dataset))
+                if res_dataset.ok and resource is not None:
+                    put(resources, (resource, s3_path))
+
+        def resource_worker():
+            while True:
+                item = resources.get()
+                if item is _DONE:
+                    return
+                if stop.is_set():
+                    continue
+
+                resource, s3_path = item
+                res_resource = attempt(self._put_resource, resource, s3_path)
+                put(results, PipelineResult('resource', resource['name'], resource['resource:name'], res_resource))
+
+        def start(target, count):
+            threads = [threading.Thread(target=target, daemon=True) for _ in range(count)]
+            for thread in threads:
+                thread.start()
+            return threads
+
+        def supervise(reader, dataset_threads, resource_threads):
+            # Each stage is told to finish only once every worker feeding it has finished
+            reader.join()
+            for _ in dataset_threads:
+                datasets.put(_DONE)
+            for thread in dataset_threads:
+                thread.join()
+            for _ in resource_threads:
+                resources.put(_DONE)
+            for thread in resource_threads:
+                thread.join()
+            put(results, _DONE)
+
+        supervisor = threading.Thread(
+            target=supervise,
+            args=(start(read, 1)[0], start(dataset_worker, self.dataset_workers),
+                  start(resource_worker, self.resource_workers)),
+            daemon=True
+        )
+        supervisor.start()
+
+        try:
+            while True:
+                result = results.get()
+                if result is _DONE:
+                    return
+                yield result
+        finally:
+            # Also reached when the caller stops early; records already in progress are allowed to finish
+            stop.set()
+            supervisor.join()
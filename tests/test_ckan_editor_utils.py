@@ -274,46 +274,3 @@ should we fail it or just log an error and continue?
 
 for now we could delete from the csv, for sure, but we need to validate objects in s3 properly as others may be missing
 """
-
-
-def test_unit_update_attributes_same():
-    au = ckan_editor_utils.AttributeUpdater()
-    assert au.update({'a':1}, {'a':2}) == {'a': 2}
-    assert au.edit_count == 1
-
-def test_unit_update_attributes_new():
-    au = ckan_editor_utils.AttributeUpdater()
-    assert au.update({'a':1}, {'b':2}) == {'a':1, 'b':2}
-    assert au.edit_count == 1
-
-def test_unit_update_attributes_multiple():
-    au = ckan_editor_utils.AttributeUpdater()
-    assert au.update({'a':1}, {'a': 2, 'b':2}) == {'a':2, 'b':2}
-    assert au.edit_count == 2
-
-def test_unit_update_attributes_nochange():
-    au = ckan_editor_utils.AttributeUpdater()
-    assert au.update({'a':1}, {'a':1}) == {'a':1}
-    assert au.edit_count == 0
-
-def test_unit_update_attributes_none():
-    au = ckan_editor_utils.AttributeUpdater()
-    assert au.update({'a':1}, None) == {'a':1}
-    assert au.edit_count == 0
-
-def test_unit_update_attributes_twice():
-    au = ckan_editor_utils.AttributeUpdater()
-    assert au.update({'a':1}, {'b':2}) == {'a':1, 'b':2}
-    assert au.update({'a': 1}, {'c': 3}) == {'a': 1, 'c': 3}
-    assert au.edit_count == 2
-
-def test_unit_update_attributes_setedits_int():
-    au = ckan_editor_utils.AttributeUpdater()
-    au.edit_count = 2
-    assert au.edit_count == 2
-
-def test_unit_update_attributes_setedits_none():
-    au = ckan_editor_utils.AttributeUpdater()
-    assert au.update({'a': 1}, {'b': 2}) == {'a': 1, 'b': 2}
-    au.edit_count = None
-    assert au.edit_count == 1
\ No newline at end of file
@@ -0,0 +1,1056 @@
+import asyncio
+import datetime
+import gzip
+import io
+import json
+import logging
+import threading
+import time
+from urllib.parse import unquote
+
+import boto3
+import pytest
+
+import ckan_editor_utils
+from ckan_editor_utils import cli
+from benchmarks import fake_ckan, fake_s3
+
+
+def _serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://{}:{}'.format(*server.server_address)
+
+
+@pytest.fixture
+def ckan():
+    # An in-memory CKAN action API, from the benchmarks, so editor calls can be checked offline
+    ckan = fake_ckan.FakeCKAN()
+    server = fake_ckan.make_server(ckan)
+    ckan.url = _serve(server) + '/api/action/'
+    yield ckan
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def s3():
+    s3 = fake_s3.FakeS3()
+    server = fake_s3.make_server(s3)
+    s3.resource = boto3.session.Session(aws_access_key_id='key', aws_secret_access_key='secret').resource(
+        's3', endpoint_url=_serve(server), region_name='us-east-1')
+    yield s3
+    server.shutdown()
+    server.server_close()
+
+
+def _dataset(name='ds1'):
+    return {'name': name, 'notes': 'Notes', 'owner_org': 'org', 'extra:identifier': name.upper()}
+
+
+def test_unit_update_attributes_same():
+    au = ckan_editor_utils.AttributeUpdater()
+    assert au.update({'a':1}, {'a':2}) == {'a': 2}
+    assert au.edit_count == 1
+
+
+def test_unit_update_attributes_new():
+    au = ckan_editor_utils.AttributeUpdater()
+    assert au.update({'a':1}, {'b':2}) == {'a':1, 'b':2}
+    assert au.edit_count == 1
+
+
+def test_unit_update_attributes_multiple():
+    au = ckan_editor_utils.AttributeUpdater()
+    assert au.update({'a':1}, {'a': 2, 'b':2}) == {'a':2, 'b':2}
+    assert au.edit_count == 2
+
+
+def test_unit_update_attributes_nochange():
+    au = ckan_editor_utils.AttributeUpdater()
+    assert au.update({'a':1}, {'a':1}) == {'a':1}
+    assert au.edit_count == 0
+
+
+def test_unit_update_attributes_none():
+    au = ckan_editor_utils.AttributeUpdater()
+    assert au.update({'a':1}, None) == {'a':1}
+    assert au.edit_count == 0
+
+
+def test_unit_update_attributes_twice():
+    au = ckan_editor_utils.AttributeUpdater()
+    assert au.update({'a':1}, {'b':2}) == {'a':1, 'b':2}
+    assert au.update({'a': 1}, {'c': 3}) == {'a': 1, 'c': 3}
+    assert au.edit_count == 2
+
+
+def test_unit_update_attributes_setedits_int():
+    au = ckan_editor_utils.AttributeUpdater()
+    au.edit_count = 2
+    assert au.edit_count == 2
+
+
+def test_unit_update_attributes_setedits_none():
+    au = ckan_editor_utils.AttributeUpdater()
+    assert au.update({'a': 1}, {'b': 2}) == {'a': 1, 'b': 2}
+    au.edit_count = None
+    assert au.edit_count == 1
+
+
+def test_unit_cache_get_set():
+    cache = ckan_editor_utils.MetadataCache(maxsize=2, ttl=60)
+    cache.set('a', {'name': 'a'})
+    assert cache.get('a') == {'name': 'a'}
+    assert cache.get('b') is None
+
+
+def test_unit_cache_evicts_least_recent():
+    cache = ckan_editor_utils.MetadataCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert len(cache) == 2
+
+
+def test_unit_cache_expires():
+    cache = ckan_editor_utils.MetadataCache(maxsize=2, ttl=-1)
+    cache.set('a', 1)
+    assert cache.get('a') is None
+
+
+def test_unit_cache_pop():
+    cache = ckan_editor_utils.MetadataCache()
+    cache.set('a', 1)
+    cache.pop('a')
+    cache.pop('missing')
+    assert cache.get('a') is None
+
+
+def test_unit_limiter_increases_on_success():
+    limiter = ckan_editor_utils.AdaptiveLimiter(initial=2, maximum=4)
+    for _ in range(20):
+        limiter.acquire()
+        limiter.release(0.01)
+    assert limiter.limit == 4
+    assert limiter.inflight == 0
+
+
+def test_unit_limiter_decreases_on_overload():
+    limiter = ckan_editor_utils.AdaptiveLimiter(initial=8, minimum=2)
+    limiter.acquire()
+    limiter.release(0.0, overloaded=True)
+    assert limiter.limit == 4
+    limiter.acquire()
+    limiter.release(0.0, overloaded=True)
+    limiter.acquire()
+    limiter.release(0.0, overloaded=True)
+    assert limiter.limit == 2
+
+
+def test_unit_limiter_decreases_on_latency():
+    limiter = ckan_editor_utils.AdaptiveLimiter(initial=8, latency_target=1.0)
+    limiter.acquire()
+    limiter.release(2.0)
+    assert limiter.limit == 4
+
+
+def test_unit_histogram_sink_summary():
+    sink = ckan_editor_utils.HistogramSink()
+    for seconds in [0.001, 0.02, 0.02, 0.3]:
+        sink.record(ckan_editor_utils.ActionMetric('package_show', seconds, 200, 10, 100, 0, None, 0.0))
+    sink.record(ckan_editor_utils.ActionMetric('package_show', 0.02, 503, 10, 0, 3, None, 0.0))
+    summary = sink.summary()['package_show']
+    assert summary['count'] == 5
+    assert summary['errors'] == 1
+    assert summary['retries'] == 3
+    assert summary['response_bytes'] == 400
+    assert 0.01 < summary['p50'] <= 0.025
+
+
+def test_unit_histogram_sink_prometheus():
+    sink = ckan_editor_utils.HistogramSink()
+    sink.record(ckan_editor_utils.ActionMetric('package_show', 0.02, 200, 10, 100, 0, None, 0.0))
+    text = sink.prometheus_text()
+    assert 'ckan_action_seconds_bucket{action="package_show",le="+Inf"} 1' in text
+    assert 'ckan_action_seconds_count{action="package_show"} 1' in text
+
+
+class _FakeResponse(object):
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+        self.ok = status_code < 400
+        self.parse_count = 0
+
+    def json(self):
+        self.parse_count += 1
+        return json.loads(self.text)
+
+
+def test_unit_response_parsed_lazily():
+    logging.getLogger('ckan_editor_utils').setLevel(logging.WARNING)
+    try:
+        raw = _FakeResponse(200, '{"success": true, "result": {"name": "a"}}')
+        cr = ckan_editor_utils.CKANResponse(raw)
+        assert raw.parse_count == 0
+        assert cr.ok
+        assert cr.result == {'name': 'a'}
+        assert raw.parse_count == 1
+    finally:
+        logging.getLogger('ckan_editor_utils').setLevel(logging.NOTSET)
+
+
+def test_unit_response_error_message():
+    cr = ckan_editor_utils.CKANResponse(_FakeResponse(404, '{"success": false, "error": {"message": "Not found"}}'))
+    assert not cr.ok
+    assert cr.status == 'not OK'
+    assert cr.result == {'message': 'Not found'}
+
+
+def test_unit_update_attributes_changes():
+    au = ckan_editor_utils.AttributeUpdater()
+    au.update({'a': 1, 'b': 2, 'c': 3}, {'a': 1, 'b': 5, 'd': 4})
+    assert au.changes == {'b': 5, 'd': 4}
+
+
+def test_unit_update_attributes_changes_none():
+    au = ckan_editor_utils.AttributeUpdater()
+    au.update({'a': 1}, {'a': 1})
+    assert au.changes == {}
+
+
+def test_unit_body_encoder_form():
+    body, headers = ckan_editor_utils.BodyEncoder().encode({'name': 'a b'})
+    assert headers['Content-Type'] == 'application/x-www-form-urlencoded'
+    assert json.loads(unquote(body)) == {'name': 'a b'}
+
+
+def test_unit_body_encoder_json():
+    body, headers = ckan_editor_utils.BodyEncoder('json').encode({'name': 'a b'})
+    assert headers['Content-Type'] == 'application/json'
+    assert json.loads(body) == {'name': 'a b'}
+
+
+def test_unit_body_encoder_gzip_threshold():
+    encoder = ckan_editor_utils.BodyEncoder('json', gzip_threshold=100)
+    body, headers = encoder.encode({'notes': 'x'})
+    assert 'Content-Encoding' not in headers
+    body, headers = encoder.encode({'notes': 'x' * 1000})
+    assert headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(body)) == {'notes': 'x' * 1000}
+
+
+class _Float(float):
+    pass
+
+
+def test_unit_dumps_matches_json():
+    module = ckan_editor_utils.ckan_editor_utils
+    data = {'f': _Float(1.5), 'nan': float('nan'), 'when': datetime.datetime(2020, 1, 1), 'big': 2 ** 70}
+    assert module._dumps(data) == json.dumps(data, default=str).encode()
+
+    pytest.importorskip('orjson')
+    # Integers beyond 64 bits fall back to json
+    assert module._dumps(data, 'orjson') == module._dumps(data)
+    del data['big']
+    assert json.loads(module._dumps(data, 'orjson')) == {'f': 1.5, 'nan': None, 'when': '2020-01-01 00:00:00'}
+
+
+def test_unit_read_csv_drops_empty_cells():
+    f = io.StringIO('name,notes,resource:name\nds1,,r1\n')
+    assert list(ckan_editor_utils.read_csv(f)) == [{'name': 'ds1', 'resource:name': 'r1'}]
+
+
+def test_unit_read_jsonl_skips_blank_lines():
+    f = io.StringIO('{"name": "ds1"}\n\n{"name": "ds2"}\n')
+    assert [r['name'] for r in ckan_editor_utils.read_jsonl(f)] == ['ds1', 'ds2']
+
+
+def test_unit_split_record():
+    dataset, resource, s3_path = ckan_editor_utils.split_record(
+        {'name': 'ds1', 'notes': 'n', 'resource:name': 'r1', 's3_path': 's3://bucket/key'})
+    assert dataset == {'name': 'ds1', 'notes': 'n'}
+    assert resource == {'name': 'ds1', 'resource:name': 'r1'}
+    assert s3_path == 's3://bucket/key'
+
+
+def test_unit_check_required_attrs():
+    with pytest.raises(ckan_editor_utils.UserException):
+        ckan_editor_utils.check_required_attrs({'name': 'ds1'}, ckan_editor_utils.DATASET_REQUIRED_ATTRS, 'Dataset')
+
+
+def test_unit_rate_limiter_spaces_requests():
+    limiter = ckan_editor_utils.RateLimiter(rate=100)
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.acquire()
+        limiter.release(0.0)
+    assert time.monotonic() - start >= 0.035
+    assert limiter.inflight == 0
+
+
+def test_unit_multipart_body_streams_without_copying():
+    data = memoryview(b'0123456789')[2:8]
+    body = ckan_editor_utils.MultipartBody({'partNumber': 1}, 'upload', data)
+    pieces = list(body)
+    assert pieces[1] is data
+    assert len(body) == sum(len(piece) for piece in pieces)
+    joined = b''.join(bytes(piece) for piece in body)
+    assert b'name="partNumber"\r\n\r\n1\r\n' in joined
+    assert b'filename="upload"' in joined and b'234567' in joined
+
+
+def test_unit_buffer_pool_reuses_buffers():
+    pool = ckan_editor_utils.BufferPool(count=2, size=16)
+    first = pool.acquire()
+    second = pool.acquire()
+    assert len(first) == 16 and first is not second
+    pool.release(first)
+    assert pool.acquire() is first
+
+
+def test_unit_part_size_policy():
+    editor = ckan_editor_utils.CKANEditor('http://localhost/api/action/', 'key', max_parts=10000)
+    mb = 1024 * 1024
+    assert editor.part_size(2 * 1024) == 5 * mb
+    assert editor.part_size(100 * 1024 * mb) == 11 * mb
+    editor.max_part_size = 8 * mb
+    assert editor.part_size(1024 * 1024 * mb) == 8 * mb
+    editor.close()
+
+
+def test_unit_match_resource_by_name():
+    editor = ckan_editor_utils.CKANEditor('http://localhost/api/action/', 'key')
+    res_show = ckan_editor_utils.CKANResponse.from_result({'name': 'ds', 'resources': [
+        {'id': 'a', 'name': 'one'}, {'id': 'b', 'name': 'two'}, {'id': 'c', 'name': 'two'}]})
+    resources_by_name = ckan_editor_utils.ckan_editor_utils._resources_by_name(res_show)
+
+    assert editor._match_resource(resources_by_name, {'resource:name': 'one'}, False) == (
+        'a', {'id': 'a', 'name': 'one'}, False)
+    assert editor._match_resource(resources_by_name, {'resource:name': 'one'}, True) is None
+    assert editor._match_resource(resources_by_name, {'resource:name': 'two'}, False) is None
+    assert editor._match_resource(resources_by_name, {'resource:name': 'new'}, True) == ('', dict(), False)
+    editor.close()
+
+
+def _record_actions(ckan, monkeypatch):
+    # Records (action, data) for every call to the fake CKAN
+    calls = []
+
+    def recording_handle(action, data):
+        calls.append((action, data))
+        return fake_ckan.FakeCKAN.handle(ckan, action, data)
+
+    monkeypatch.setattr(ckan, 'handle', recording_handle)
+    return calls
+
+
+def test_unit_build_index_skips_package_show(ckan, monkeypatch):
+    with ckan_editor_utils.CKANEditorSession(ckan.url, 'key') as editor:
+        for i in range(5):
+            editor.put_dataset(_dataset('ds{}'.format(i)))
+
+        calls = _record_actions(ckan, monkeypatch)
+        assert editor.build_index(rows=2) == 5
+        assert [(action, data['start'], data['rows']) for action, data in calls] == [
+            ('package_search', '0', '2'), ('package_search', '2', '2'), ('package_search', '4', '2')]
+
+        del calls[:]
+        assert editor.put_dataset(_dataset('ds3')).result['name'] == 'ds3'
+        assert calls == []
+
+        assert editor.put_dataset(_dataset('new')).ok
+        assert [action for action, _ in calls] == ['package_show', 'package_create']
+        del calls[:]
+        assert editor.put_dataset(_dataset('new')).ok
+        assert calls == []
+
+
+def _search_starts(calls):
+    return [int(data['start']) for action, data in calls if action == 'package_search']
+
+
+@pytest.mark.parametrize('prefetch', [True, False])
+def test_unit_package_query_iter_pages(ckan, monkeypatch, prefetch):
+    for i in range(5):
+        ckan.action_package_create(_dataset('ds{}'.format(i)))
+    calls = _record_actions(ckan, monkeypatch)
+
+    datasets = ckan_editor_utils.package_query_iter(ckan.url, 'key', rows=2, prefetch=prefetch)
+    assert next(datasets)['name'] == 'ds0'
+    # With prefetch the second page is requested while the first is still being used
+    deadline = time.monotonic() + 5
+    while prefetch and len(calls) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert _search_starts(calls) == ([0, 2] if prefetch else [0])
+
+    assert [d['name'] for d in datasets] == ['ds1', 'ds2', 'ds3', 'ds4']
+    assert _search_starts(calls) == [0, 2, 4]
+
+    del ckan.datasets['ds4']
+    del calls[:]
+    assert len(list(ckan_editor_utils.package_query_iter(ckan.url, 'key', rows=2, prefetch=prefetch))) == 4
+    assert _search_starts(calls) == [0, 2]
+
+
+def test_unit_error_response_logs_its_message(caplog):
+    with caplog.at_level(logging.WARNING, logger='ckan_editor_utils'):
+        cr = ckan_editor_utils.ckan_editor_utils._error_response('Invalid file', path='x')
+    assert not cr.ok
+    assert cr.result == {'message': 'Invalid file', 'path': 'x'}
+    assert 'null' not in caplog.text
+    assert 'Invalid file' in caplog.text
+
+
+class _FailingEditor(ckan_editor_utils.CKANEditor):
+    def put_dataset(self, data, skip_existing=True):
+        if data['name'] == 'bad':
+            raise TypeError('organization is None')
+        return ckan_editor_utils.CKANResponse.from_result(data)
+
+    def delete_dataset(self, dataset_id, delete_resources=True):
+        return self.put_dataset({'name': dataset_id})
+
+
+def test_unit_put_datasets_reports_each_failure():
+    editor = _FailingEditor('http://localhost/api/action/', 'key')
+    names = ['a', 'bad', 'b', 'c', 'd']
+    results = dict(editor.put_datasets([{'name': name} for name in names], max_workers=2))
+    assert sorted(results) == sorted(names)
+    assert not results['bad'].ok
+    assert all(results[name].ok for name in names if name != 'bad')
+
+    results = dict(editor.delete_datasets(names, max_workers=2))
+    assert sorted(results) == sorted(names)
+    assert not results['bad'].ok
+    editor.close()
+
+
+def test_unit_delete_by_id_forgets_cached_dataset(ckan):
+    with ckan_editor_utils.CKANEditorSession(ckan.url, 'key', cache_size=100) as editor:
+        dataset_id = editor.put_dataset(_dataset()).result['id']
+        assert dict(editor.delete_datasets([dataset_id]))[dataset_id].ok
+        assert 'ds1' not in ckan.datasets
+
+        assert editor.put_dataset(_dataset()).ok
+        assert 'ds1' in ckan.datasets
+
+
+def test_unit_delete_dataset_deletes_resources_in_turn(ckan, monkeypatch):
+    active = []
+    overlapped = []
+
+    def slow_handle(action, data):
+        if action != 'resource_delete':
+            return fake_ckan.FakeCKAN.handle(ckan, action, data)
+        active.append(action)
+        overlapped.append(len(active) > 1)
+        time.sleep(0.05)
+        try:
+            return fake_ckan.FakeCKAN.handle(ckan, action, data)
+        finally:
+            active.pop()
+
+    with ckan_editor_utils.CKANEditorSession(ckan.url, 'key') as editor:
+        editor.put_dataset(_dataset())
+        for name in ['r1', 'r2', 'r3']:
+            ckan_editor_utils.ckan_editor_utils.resource_create(ckan.url, 'key', {'package_id': 'ds1', 'name': name})
+        monkeypatch.setattr(ckan, 'handle', slow_handle)
+        assert editor.delete_dataset('ds1').ok
+
+    assert overlapped == [False, False, False]
+    assert ckan.datasets == {}
+
+
+def _record_writes(ckan, monkeypatch):
+    # Records (action, data) for the dataset and resource writes
+    calls = []
+
+    def recording_handle(action, data):
+        if action.split('_')[-1] in ('create', 'update', 'patch'):
+            calls.append((action, {k: v for k, v in data.items() if k != 'upload'}))
+        return fake_ckan.FakeCKAN.handle(ckan, action, data)
+
+    monkeypatch.setattr(ckan, 'handle', recording_handle)
+    return calls
+
+
+def test_unit_patch_updates_send_only_changes(ckan, tmp_path, monkeypatch):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(b'data')
+    resource = {'name': 'ds1', 'resource:name': 'r1', 'resource:description': 'Description'}
+    with ckan_editor_utils.CKANEditorSession(ckan.url, 'key', patch_updates=True) as editor:
+        dataset_id = editor.put_dataset(_dataset()).result['id']
+        assert editor.put_resource_from_file(dict(resource), str(path)).ok
+        resource_id = ckan.datasets['ds1']['resources'][0]['id']
+
+        calls = _record_writes(ckan, monkeypatch)
+        assert editor.put_dataset(dict(_dataset(), notes='New notes'), skip_existing=False).ok
+        assert editor.put_dataset(dict(_dataset(), notes='New notes'), skip_existing=False).ok
+        assert calls == [('package_patch', {'id': dataset_id, 'notes': 'New notes'})]
+        assert ckan.datasets['ds1']['extra:identifier'] == 'DS1'
+
+        del calls[:]
+        changed = dict(resource, **{'resource:description': 'New description'})
+        assert editor.put_resource_from_file(changed, str(path), skip_existing=False).ok
+        assert calls == [('resource_patch', {'id': resource_id, 'description': 'New description',
+                                             'resource:description': 'New description'})]
+
+        del calls[:]
+        assert editor.put_resource_from_file(dict(changed), str(path), skip_existing=False).ok
+        assert calls == []
+
+
+class _RecordingEditor(object):
+    def __init__(self):
+        self.save_locks = dict()
+
+    def put_dataset(self, data, skip_existing=True):
+        return ckan_editor_utils.CKANResponse.from_result(data)
+
+    def put_resource_from_s3(self, data, s3_path, skip_existing=True, skip_unchanged=False, save_lock=None):
+        self.save_locks[data['resource:name']] = save_lock
+        return ckan_editor_utils.CKANResponse.from_result(data)
+
+
+def test_unit_pipeline_reports_malformed_lines_and_continues():
+    manifest = io.StringIO('{"name": "ds1"}\n{"name": \n[1, 2]\n{"name": "ds2"}\n')
+    pipeline = ckan_editor_utils.Pipeline(_RecordingEditor(), dataset_workers=2)
+    results = list(pipeline.run(ckan_editor_utils.read_jsonl(manifest, parse=False)))
+
+    assert sorted(r.name for r in results if r.response.ok) == ['ds1', 'ds2']
+    failed = [r for r in results if not r.response.ok]
+    assert [r.stage for r in failed] == ['read', 'read']
+
+
+def test_unit_pipeline_locks_resource_writes_per_dataset():
+    editor = _RecordingEditor()
+    records = [dict(name=name, s3_path='s3://bucket/' + resource_name, **{'resource:name': resource_name,
+                                                                        'resource:description': 'Description'})
+               for name, resource_name in [('ds1', 'a'), ('ds1', 'b'), ('ds2', 'c')]]
+    pipeline = ckan_editor_utils.Pipeline(editor, resource_workers=2, put_datasets=False)
+    assert all(r.response.ok for r in pipeline.run(records))
+
+    assert editor.save_locks['a'] is editor.save_locks['b'] is pipeline._dataset_lock('ds1')
+    assert editor.save_locks['c'] is pipeline._dataset_lock('ds2')
+
+
+def _stubbed_async_editor(s3, results, **editor_options):
+    # CKAN actions are answered from results, a dict of name -> response or exception, and recorded in calls
+    pytest.importorskip('aiohttp')
+    from ckan_editor_utils.aio import AsyncCKANEditor
+
+    editor = AsyncCKANEditor('http://localhost/api/action/', 'key', s3_resource=s3.resource, **editor_options)
+    editor.calls = []
+
+    async def action(name, data=None, params=None, form=None):
+        editor.calls.append(name)
+        result = results.get(name, ckan_editor_utils.CKANResponse.from_result({'id': 'upload-id'}))
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    editor.action = action
+    return editor
+
+
+def _async_upload(editor, s3, size):
+    s3.add_object('bucket', 'data.bin', size)
+    summary = s3.resource.ObjectSummary('bucket', 'data.bin')
+    # asyncio.run needs Python 3.7
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(editor._upload_s3_resource('resource-id', summary))
+    finally:
+        loop.close()
+
+
+def test_unit_async_upload_returns_failed_initiate(s3):
+    failed = ckan_editor_utils.ckan_editor_utils._error_response('Not authorised')
+    editor = _stubbed_async_editor(s3, {'cloudstorage_initiate_multipart': failed})
+    assert _async_upload(editor, s3, 1024) is failed
+    assert editor.calls == ['cloudstorage_initiate_multipart']
+
+
+def test_unit_async_upload_aborts_on_timeout(s3):
+    editor = _stubbed_async_editor(s3, {'cloudstorage_upload_multipart': asyncio.TimeoutError()})
+    res = _async_upload(editor, s3, 1024)
+    assert not res.ok
+    assert editor.calls[-2:] == ['cloudstorage_abort_multipart', 'resource_delete']
+
+
+def test_unit_async_upload_keeps_resource_after_lost_finish(s3):
+    shown = ckan_editor_utils.CKANResponse.from_result({'id': 'resource-id'})
+    editor = _stubbed_async_editor(s3, {'cloudstorage_finish_multipart': asyncio.TimeoutError(),
+                                        'resource_show': shown})
+    assert not _async_upload(editor, s3, 1024).ok
+    assert editor.calls[-2:] == ['cloudstorage_finish_multipart', 'resource_show']
+
+
+def test_unit_async_upload_follows_part_size_policy(s3):
+    editor = _stubbed_async_editor(s3, {}, chunk_size=1024 * 1024, max_parts=3)
+    assert editor.part_size(5 * 1024 * 1024) == 2 * 1024 * 1024
+    _async_upload(editor, s3, 5 * 1024 * 1024)
+    assert editor.calls.count('cloudstorage_upload_multipart') == 3
+
+
+def test_unit_failed_upload_deletes_resource_under_save_lock(ckan, monkeypatch):
+    module = ckan_editor_utils.ckan_editor_utils
+    save_lock = threading.Lock()
+    held = []
+    resource_delete = module.resource_delete
+
+    def recording_delete(*args, **kwargs):
+        held.append(save_lock.locked())
+        return resource_delete(*args, **kwargs)
+
+    def read_part(offset, length):
+        raise IOError('read failed')
+
+    monkeypatch.setattr(module, 'resource_delete', recording_delete)
+    with ckan_editor_utils.CKANEditorSession(ckan.url, 'key') as editor:
+        editor.put_dataset(_dataset())
+        res_create = module.resource_create(ckan.url, 'key', {'package_id': 'ds1', 'name': 'r1'})
+        resource_id = res_create.json()['result']['id']
+        res = editor._upload_multipart(resource_id, 'data.bin', 1024, read_part, read_errors=(IOError,),
+                                       save_lock=save_lock)
+
+    assert not res.ok
+    assert held == [True]
+    assert not save_lock.locked()
+    assert ckan.datasets['ds1']['resources'] == []
+
+
+def test_unit_retries_skip_creates_after_503(ckan, monkeypatch):
+    module = ckan_editor_utils.ckan_editor_utils
+    calls = []
+
+    def overloaded(action, data):
+        calls.append(action)
+        return 503, 'Service unavailable'
+
+    monkeypatch.setattr(ckan, 'handle', overloaded)
+    resource = {'package_id': 'ds1', 'name': 'r1'}
+    session = ckan_editor_utils.make_session('key', retries=2, backoff=0.001)
+
+    assert module.resource_create(ckan.url, 'key', resource, session=session).status_code == 503
+    assert module.resource_update(ckan.url, 'key', dict(resource, id='r1'), session=session).status_code == 503
+    assert calls == ['resource_create'] + ['resource_update'] * 3
+
+    del calls[:]
+    session = ckan_editor_utils.make_session('key', retries=2, backoff=0.001, retry_creates=True)
+    module.resource_create(ckan.url, 'key', resource, session=session)
+    assert calls == ['resource_create'] * 3
+
+
+def test_unit_retries_creates_when_never_sent(monkeypatch):
+    module = ckan_editor_utils.ckan_editor_utils
+    attempts = []
+    send = module.HTTPAdapter.send
+
+    def counting_send(self, request, **kwargs):
+        attempts.append(request.url)
+        return send(self, request, **kwargs)
+
+    monkeypatch.setattr(module.HTTPAdapter, 'send', counting_send)
+    session = ckan_editor_utils.make_session('key', retries=2, backoff=0.001)
+    with pytest.raises(module.requests.exceptions.ConnectionError):
+        # Nothing listens on the discard port, so the connection is refused before anything is sent
+        module.resource_create('http://127.0.0.1:9/api/action/', 'key', {'name': 'r1'}, session=session)
+    assert len(attempts) == 3
+
+
+def _record_upload_calls(ckan, monkeypatch, failing_parts=()):
+    # Records (action, part number) for the multipart calls, answering the parts in failing_parts with an error
+    calls = []
+
+    def recording_handle(action, data):
+        part = int(data['partNumber']) if action == 'cloudstorage_upload_multipart' else None
+        if action.startswith('cloudstorage_'):
+            calls.append((action, part))
+        if part in failing_parts:
+            return 500, dict(success=False, error=dict(message='Part {} failed'.format(part)))
+        return fake_ckan.FakeCKAN.handle(ckan, action, data)
+
+    monkeypatch.setattr(ckan, 'handle', recording_handle)
+    return calls
+
+
+def _put_s3_resource(ckan, s3, size=2 * 1024 * 1024, **editor_options):
+    s3.add_object('bucket', 'data.bin', size)
+    with ckan_editor_utils.CKANEditorSession(ckan.url, 'key', s3_resource=s3.resource, chunk_size=1024 * 1024,
+                                             **editor_options) as editor:
+        editor.put_dataset(_dataset())
+        resource = {'name': 'ds1', 'resource:name': 'r1', 'resource:description': 'Description'}
+        return editor.put_resource_from_s3(resource, 's3://bucket/data.bin')
+
+
+def test_unit_lost_finish_response_keeps_resource(ckan, s3, monkeypatch):
+    finishes = []
+
+    def dropping_handle(action, data):
+        response = fake_ckan.FakeCKAN.handle(ckan, action, data)
+        if action == 'cloudstorage_finish_multipart':
+            finishes.append(data['uploadId'])
+            # CKAN completed the upload, but the response never arrives
+            return None, None
+        return response
+
+    monkeypatch.setattr(ckan, 'handle', dropping_handle)
+    res = _put_s3_resource(ckan, s3)
+    assert not res.ok
+    assert len(finishes) == 1
+    resources = ckan.datasets['ds1']['resources']
+    assert len(resources) == 1
+    assert 'upload_in_progress' not in resources[0]
+
+
+def test_unit_failed_finish_deletes_incomplete_resource(ckan, s3, monkeypatch):
+    def failing_handle(action, data):
+        if action == 'cloudstorage_finish_multipart':
+            return 500, dict(success=False, error=dict(message='Could not commit'))
+        return fake_ckan.FakeCKAN.handle(ckan, action, data)
+
+    monkeypatch.setattr(ckan, 'handle', failing_handle)
+    res = _put_s3_resource(ckan, s3)
+    assert res.result == {'message': 'Could not commit'}
+    assert ckan.datasets['ds1']['resources'] == []
+    assert ckan.uploads == {}
+
+
+def _uploaded_parts(calls):
+    return [part for action, part in calls if action == 'cloudstorage_upload_multipart']
+
+
+def _put_checkpointed_resource(ckan, s3, tmp_path):
+    with ckan_editor_utils.CKANEditorSession(ckan.url, 'key', s3_resource=s3.resource, chunk_size=1024 * 1024,
+                                             checkpoint_dir=str(tmp_path)) as editor:
+        editor.put_dataset(_dataset())
+        resource = {'name': 'ds1', 'resource:name': 'r1', 'resource:description': 'Description'}
+        return editor.put_resource_from_s3(resource, 's3://bucket/data.bin')
+
+
+def test_unit_checkpoint_resumes_remaining_parts(ckan, s3, tmp_path, monkeypatch):
+    s3.add_object('bucket', 'data.bin', 6 * 1024 * 1024)
+    calls = _record_upload_calls(ckan, monkeypatch, failing_parts=(4,))
+    res = _put_checkpointed_resource(ckan, s3, tmp_path)
+    assert not res.ok
+    assert 4 in res.result['failed_parts']
+    checkpoint = json.loads(open(res.result['checkpoint']).read())
+    assert checkpoint['parts'] == [1, 2, 3]
+    assert len(ckan.datasets['ds1']['resources']) == 1
+
+    calls = _record_upload_calls(ckan, monkeypatch)
+    res = _put_checkpointed_resource(ckan, s3, tmp_path)
+    assert res.ok
+    assert res.result['size'] == 6 * 1024 * 1024
+    assert [action for action, _ in calls] == ['cloudstorage_upload_multipart'] * 3 + ['cloudstorage_finish_multipart']
+    assert _uploaded_parts(calls) == [4, 5, 6]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_unit_checkpoint_restarts_when_etag_changes(ckan, s3, tmp_path, monkeypatch):
+    s3.add_object('bucket', 'data.bin', 6 * 1024 * 1024)
+    _record_upload_calls(ckan, monkeypatch, failing_parts=(4,))
+    assert not _put_checkpointed_resource(ckan, s3, tmp_path).ok
+
+    monkeypatch.setattr(s3, 'etag', lambda bucket, key, size: '"changed"')
+    calls = _record_upload_calls(ckan, monkeypatch)
+    res = _put_checkpointed_resource(ckan, s3, tmp_path)
+    assert res.ok
+    assert calls[:2] == [('cloudstorage_abort_multipart', None), ('cloudstorage_initiate_multipart', None)]
+    assert _uploaded_parts(calls) == [1, 2, 3, 4, 5, 6]
+    assert res.result['size'] == 6 * 1024 * 1024
+
+
+def test_unit_checkpoint_restarts_when_upload_expired(ckan, s3, tmp_path, monkeypatch):
+    s3.add_object('bucket', 'data.bin', 6 * 1024 * 1024)
+    _record_upload_calls(ckan, monkeypatch, failing_parts=(4,))
+    assert not _put_checkpointed_resource(ckan, s3, tmp_path).ok
+
+    ckan.uploads.clear()
+    calls = _record_upload_calls(ckan, monkeypatch)
+    res = _put_checkpointed_resource(ckan, s3, tmp_path)
+    assert res.ok
+    assert calls[:2] == [('cloudstorage_upload_multipart', 4), ('cloudstorage_abort_multipart', None)]
+    assert _uploaded_parts(calls)[1:] == [1, 2, 3, 4, 5, 6]
+    assert res.result['size'] == 6 * 1024 * 1024
+    assert len(ckan.datasets['ds1']['resources']) == 1
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_unit_checkpoint_restarts_when_already_finished(ckan, s3, tmp_path, monkeypatch):
+    s3.add_object('bucket', 'data.bin', 2 * 1024 * 1024)
+    _record_upload_calls(ckan, monkeypatch, failing_parts=(2,))
+    checkpoint_path = _put_checkpointed_resource(ckan, s3, tmp_path).result['checkpoint']
+    checkpoint = json.loads(open(checkpoint_path).read())
+
+    _record_upload_calls(ckan, monkeypatch)
+    assert _put_checkpointed_resource(ckan, s3, tmp_path).ok
+    # As if the process had stopped after the finish but before removing the checkpoint
+    with open(checkpoint_path, 'w') as f:
+        json.dump(dict(checkpoint, parts=[1, 2]), f)
+
+    calls = _record_upload_calls(ckan, monkeypatch)
+    res = _put_checkpointed_resource(ckan, s3, tmp_path)
+    assert res.ok
+    assert [action for action, _ in calls[:3]] == ['cloudstorage_finish_multipart', 'cloudstorage_abort_multipart',
+                                                  'cloudstorage_initiate_multipart']
+    assert _uploaded_parts(calls) == [1, 2]
+    assert len(ckan.datasets['ds1']['resources']) == 1
+    assert list(tmp_path.iterdir()) == []
+
+
+def _put_file_resource(ckan, path, **editor_options):
+    with ckan_editor_utils.CKANEditorSession(ckan.url, 'key', chunk_size=1024 * 1024, **editor_options) as editor:
+        if 'ds1' not in ckan.datasets:
+            editor.put_dataset(_dataset())
+        resource = {'name': 'ds1', 'resource:name': 'r1', 'resource:description': 'Description'}
+        return editor.put_resource_from_file(resource, str(path))
+
+
+def test_unit_put_resource_from_file_sends_every_part(ckan, tmp_path, monkeypatch):
+    content = bytes(range(256)) * (14 * 1024)
+    path = tmp_path / 'data.bin'
+    path.write_bytes(content)
+    parts = dict()
+
+    def recording_handle(action, data):
+        if action == 'cloudstorage_upload_multipart':
+            parts[int(data['partNumber'])] = data['upload']
+        return fake_ckan.FakeCKAN.handle(ckan, action, data)
+
+    monkeypatch.setattr(ckan, 'handle', recording_handle)
+    res = _put_file_resource(ckan, path, upload_workers=3)
+    assert res.ok
+    assert res.result['size'] == len(content)
+    assert sorted(parts) == [1, 2, 3, 4]
+    assert b''.join(parts[part] for part in sorted(parts)) == content
+    assert ckan.datasets['ds1']['resources'][0]['size'] == len(content)
+
+
+def test_unit_put_resource_from_file_empty(ckan, tmp_path, monkeypatch):
+    path = tmp_path / 'empty.bin'
+    path.write_bytes(b'')
+    calls = _record_upload_calls(ckan, monkeypatch)
+    res = _put_file_resource(ckan, path)
+    assert res.ok
+    assert res.result['size'] == 0
+    assert [action for action, _ in calls] == ['cloudstorage_initiate_multipart', 'cloudstorage_finish_multipart']
+
+
+def test_unit_put_resource_from_file_missing(ckan, tmp_path):
+    res = _put_file_resource(ckan, tmp_path / 'missing.bin')
+    assert not res.ok
+    assert res.result['message'].startswith('Invalid file: ')
+    assert ckan.datasets['ds1']['resources'] == []
+
+
+def test_unit_put_resource_from_file_resumes_from_checkpoint(ckan, tmp_path, monkeypatch):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(b'x' * (3 * 1024 * 1024))
+    checkpoint_dir = tmp_path / 'checkpoints'
+    checkpoint_dir.mkdir()
+
+    _record_upload_calls(ckan, monkeypatch, failing_parts=(2,))
+    res = _put_file_resource(ckan, path, checkpoint_dir=str(checkpoint_dir))
+    assert not res.ok
+    assert json.loads(open(res.result['checkpoint']).read())['parts'] == [1]
+
+    calls = _record_upload_calls(ckan, monkeypatch)
+    res = _put_file_resource(ckan, path, checkpoint_dir=str(checkpoint_dir))
+    assert res.ok
+    assert res.result['size'] == 3 * 1024 * 1024
+    assert _uploaded_parts(calls) == [2, 3]
+    assert list(checkpoint_dir.iterdir()) == []
+    assert len(ckan.datasets['ds1']['resources']) == 1
+
+
+def _record_single_uploads(ckan, monkeypatch):
+    # Records (action, uploaded content) for resource writes and any multipart call
+    calls = []
+
+    def recording_handle(action, data):
+        if action.startswith('cloudstorage_') or action in ('resource_create', 'resource_patch', 'resource_update'):
+            calls.append((action, data.get('upload')))
+        return fake_ckan.FakeCKAN.handle(ckan, action, data)
+
+    monkeypatch.setattr(ckan, 'handle', recording_handle)
+    return calls
+
+
+def test_unit_single_upload_from_s3(ckan, s3, monkeypatch):
+    s3.add_object('bucket', 'small.bin', 100 * 1024)
+    calls = _record_single_uploads(ckan, monkeypatch)
+    resource = {'name': 'ds1', 'resource:name': 'r1', 'resource:description': 'Description'}
+    with ckan_editor_utils.CKANEditorSession(ckan.url, 'key', s3_resource=s3.resource,
+                                             single_upload_max_size=1024 * 1024) as editor:
+        editor.put_dataset(_dataset())
+        assert editor.put_resource_from_s3(dict(resource), 's3://bucket/small.bin').ok
+        assert editor.put_resource_from_s3(dict(resource), 's3://bucket/small.bin', skip_existing=False).ok
+
+    content = fake_s3.FakeS3.read(0, 100 * 1024)
+    assert calls == [('resource_create', content), ('resource_patch', content)]
+    assert len(ckan.datasets['ds1']['resources']) == 1
+
+
+def test_unit_single_upload_from_file(ckan, tmp_path, monkeypatch):
+    small = tmp_path / 'small.bin'
+    small.write_bytes(b'small')
+    calls = _record_single_uploads(ckan, monkeypatch)
+    assert _put_file_resource(ckan, small, single_upload_max_size=5).ok
+    assert calls == [('resource_create', b'small')]
+
+    del calls[:]
+    large = tmp_path / 'large.bin'
+    large.write_bytes(b'larger')
+    with ckan_editor_utils.CKANEditorSession(ckan.url, 'key', single_upload_max_size=5) as editor:
+        resource = {'name': 'ds1', 'resource:name': 'r2', 'resource:description': 'Description'}
+        assert editor.put_resource_from_file(resource, str(large)).ok
+    assert [action for action, _ in calls] == ['resource_create', 'cloudstorage_initiate_multipart',
+                                               'cloudstorage_upload_multipart', 'cloudstorage_finish_multipart']
+
+
+def test_unit_rejects_objects_with_too_many_parts(ckan, s3, tmp_path):
+    s3.add_object('bucket', 'big.bin', 3 * 1024 * 1024)
+    big = tmp_path / 'big.bin'
+    big.write_bytes(b'x' * (3 * 1024 * 1024))
+    resource = {'name': 'ds1', 'resource:name': 'r1', 'resource:description': 'Description'}
+    with ckan_editor_utils.CKANEditorSession(ckan.url, 'key', s3_resource=s3.resource, chunk_size=1024 * 1024,
+                                             max_part_size=1024 * 1024, max_parts=2) as editor:
+        editor.put_dataset(_dataset())
+        with pytest.raises(ckan_editor_utils.UserException):
+            editor.put_resource_from_s3(dict(resource), 's3://bucket/big.bin')
+        with pytest.raises(ckan_editor_utils.UserException):
+            editor.put_resource_from_file(dict(resource), str(big))
+
+    assert ckan.datasets['ds1']['resources'] == []
+    assert ckan.uploads == {}
+
+
+def test_unit_skip_unchanged_records_and_checks_fingerprint(ckan, s3, tmp_path, monkeypatch):
+    s3.add_object('bucket', 'data.bin', 2 * 1024 * 1024)
+    resource = {'name': 'ds1', 'resource:name': 'r1', 'resource:description': 'Description'}
+    # The checkpoint keeps the resource after a failed upload, so it can be checked for a fingerprint
+    with ckan_editor_utils.CKANEditorSession(ckan.url, 'key', s3_resource=s3.resource, chunk_size=1024 * 1024,
+                                             checkpoint_dir=str(tmp_path)) as editor:
+        editor.put_dataset(_dataset())
+
+        def put():
+            return editor.put_resource_from_s3(dict(resource), 's3://bucket/data.bin', skip_existing=False,
+                                               skip_unchanged=True)
+
+        _record_upload_calls(ckan, monkeypatch, failing_parts=(2,))
+        assert not put().ok
+        assert 's3_etag' not in ckan.datasets['ds1']['resources'][0]
+
+        calls = _record_upload_calls(ckan, monkeypatch)
+        assert put().ok
+        saved = ckan.datasets['ds1']['resources'][0]
+        assert saved['s3_etag'] == s3.etag('bucket', 'data.bin', 2 * 1024 * 1024)
+        assert saved['s3_size'] == str(2 * 1024 * 1024)
+        assert saved['s3_last_modified'].startswith('2020-01-01 00:00:00')
+        assert _uploaded_parts(calls) == [2]
+
+        calls = _record_upload_calls(ckan, monkeypatch)
+        assert put().ok
+        assert calls == []
+
+
+def test_unit_put_resources_from_s3_batch(ckan, s3):
+    for key in ['old.bin', 'new.bin', 'other.bin']:
+        s3.add_object('bucket', key, 1536 * 1024)
+
+    def resource(name):
+        return {'resource:name': name, 'resource:description': 'Description of ' + name}
+
+    with ckan_editor_utils.CKANEditorSession(ckan.url, 'key', s3_resource=s3.resource,
+                                             chunk_size=1024 * 1024) as editor:
+        editor.put_dataset(_dataset())
+        assert editor.put_resource_from_s3(dict(resource('old'), name='ds1'), 's3://bucket/old.bin').ok
+        old_id = ckan.datasets['ds1']['resources'][0]['id']
+
+        batch = [(resource('old'), 's3://bucket/old.bin'), (resource('new'), 's3://bucket/new.bin'),
+                 (resource('new'), 's3://bucket/other.bin'), (resource('missing'), 's3://bucket/missing.bin')]
+        results = list(editor.put_resources_from_s3('ds1', batch, skip_existing=False, max_workers=2))
+
+    assert sorted(name for name, _ in results) == ['missing', 'new', 'new', 'old']
+    failed = {name: res.result['message'] for name, res in results if not res.ok}
+    assert failed['new'] == 'Duplicate resource name: new'
+    assert failed['missing'].startswith('Invalid S3 object: ')
+    assert [res.result['size'] for _, res in results if res.ok] == [1536 * 1024] * 2
+
+    resources = {r['name']: r for r in ckan.datasets['ds1']['resources']}
+    assert sorted(resources) == ['new', 'old']
+    assert resources['old']['id'] == old_id
+    assert resources['old']['description'] == 'Description of old'
+    assert not any('upload_in_progress' in r for r in resources.values())
+
+
+def test_unit_resolve_s3_objects_lists_each_prefix(s3):
+    for i in range(3000):
+        s3.add_object('bucket', 'x/f{:04d}.bin'.format(i), 1000 + i)
+        s3.add_object('bucket', 'y/g{:04d}.bin'.format(i), 1000 + i)
+    s3.add_object('other', 'top.bin', 5)
+
+    calls = []
+
+    def record(model, params, **kwargs):
+        calls.append((model.name, params.get('Prefix'), params.get('StartAfter'), params.get('ContinuationToken')))
+
+    s3.resource.meta.client.meta.events.register('before-parameter-build.s3', record)
+
+    paths = ['s3://bucket/x/f0005.bin', 's3://bucket/x/f1200.bin', 's3://bucket/y/g2500.bin', 's3://other/top.bin',
+             's3://bucket/z/missing.bin']
+    with ckan_editor_utils.CKANEditorSession('http://localhost/api/action/', 'key', s3_resource=s3.resource) as editor:
+        s3_objects = editor.resolve_s3_objects(paths, max_workers=4)
+        found = {path: (summary.size, summary.e_tag, summary.last_modified.year)
+                 for path, summary in s3_objects.items()}
+
+    assert found == {
+        's3://bucket/x/f0005.bin': (1005, s3.etag('bucket', 'x/f0005.bin', 1005), 2020),
+        's3://bucket/x/f1200.bin': (2200, s3.etag('bucket', 'x/f1200.bin', 2200), 2020),
+        's3://bucket/y/g2500.bin': (3500, s3.etag('bucket', 'y/g2500.bin', 3500), 2020),
+        's3://other/top.bin': (5, s3.etag('other', 'top.bin', 5), 2020),
+    }
+    # Each listing starts just before its first wanted key. x/ needs a second page of 1000 keys to reach f1200,
+    #  then stops without reading the rest, and nothing is looked up object by object
+    assert sorted(calls, key=str) == sorted([
+        ('ListObjectsV2', 'x/', 'x/f0005.bi', None),
+        ('ListObjectsV2', 'x/', 'x/f0005.bi', 'x/f1004.bin'),
+        ('ListObjectsV2', 'y/', 'y/g2500.bi', None),
+        ('ListObjectsV2', '', 'top.bi', None),
+        ('ListObjectsV2', 'z/', 'z/missing.bi', None),
+    ], key=str)
+
+
+def _run_cli(ckan, tmp_path, command, lines):
+    manifest = tmp_path / 'manifest.jsonl'
+    manifest.write_text('\n'.join(lines) + '\n')
+    return cli.main([command, str(manifest), '--url', ckan.url, '--key', 'key', '--workers', '2',
+                     '--progress-interval', '0'])
+
+
+def test_unit_cli_put_reports_bad_records(ckan, tmp_path, caplog):
+    lines = [json.dumps(_dataset('a')), '{"name": ', json.dumps({'name': 'b'}), json.dumps(_dataset('c'))]
+    assert _run_cli(ckan, tmp_path, 'put', lines) == 1
+    assert sorted(ckan.datasets) == ['a', 'c']
+    assert 'Invalid record' in caplog.text
+    assert 'dataset b failed' in caplog.text
+
+
+def test_unit_cli_delete_reports_bad_records(ckan, tmp_path, caplog):
+    with ckan_editor_utils.CKANEditorSession(ckan.url, 'key') as editor:
+        ids = {name: editor.put_dataset(_dataset(name)).result['id'] for name in ['a', 'b', 'c']}
+
+    lines = [json.dumps({'name': 'a'}), '{"name": ', json.dumps({'notes': 'Notes'}), json.dumps({'id': ids['b']})]
+    assert _run_cli(ckan, tmp_path, 'delete', lines) == 1
+    assert sorted(ckan.datasets) == ['c']
+    assert caplog.text.count('Invalid record') >= 2
+    assert 'neither an id nor a name' in caplog.text
+
+    assert _run_cli(ckan, tmp_path, 'delete', [json.dumps({'name': 'c'})]) == 0
+    assert ckan.datasets == {}